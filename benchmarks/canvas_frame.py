@@ -0,0 +1,117 @@
+#
+# Frame time of panning and zooming the canvas for a growing amount of layers
+# and match items. Pan and zoom are a single transform of the view's root item,
+# the original implementation repositioned every item on every mouse move. That
+# per-item update is timed alongside the transform update, the frames include
+# drawing everything that is visible
+#
+#   python -m benchmarks.canvas_frame [layer_count ...]
+#
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+
+from PyQt5.QtCore import QPointF
+from PyQt5.QtWidgets import QApplication
+
+LayerSize = 512
+MatchesPerLayer = 100
+FrameCount = 50
+
+
+def make_view(layer_count):
+    import src.ui.canvas.view as view
+    import src.ui.canvas.layers as cvLayers
+    import src.ui.canvas.matches as cvMatches
+    import src.backend.layers as beLayers
+
+    graphics_view = view.GraphicsView()
+    graphics_view.resize(1280, 800)
+
+    rng = np.random.default_rng(0)
+    pixels = (rng.random((LayerSize, LayerSize, 3)) * 255).astype(np.uint8)
+
+    layers = []
+    for i in range(layer_count):
+        be_layer = beLayers.Layer()
+        be_layer.setImageData("", pixels)
+
+        cv_layer = cvLayers.PixmapLayer()
+        cv_layer.linkBackendLayer(be_layer)
+        cv_layer.setPosition(QPointF(40 * i, 30 * i))
+        graphics_view.addItem(cv_layer)
+        layers.append(cv_layer)
+
+    # Matches between consecutive layers
+    for i in range(1, layer_count):
+        matches = cvMatches.MatchesLayer()
+        matches.setLayers(layers[i - 1], layers[i])
+        points = rng.random((MatchesPerLayer, 2)) * LayerSize
+        matches.addMatches(points, points)
+        graphics_view.addItem(matches)
+
+    return graphics_view
+
+
+def reposition_items(graphics_view, delta):
+    # The per-item update the view transform replaces
+    for item in graphics_view._items:
+        item.setPos(item.pos() + delta)
+
+
+def measure(graphics_view, step, render = True):
+    start_time = time.perf_counter()
+    for i in range(FrameCount):
+        step(i)
+        if render:
+            graphics_view.viewport().grab()
+    return (time.perf_counter() - start_time) * 1_000 / FrameCount
+
+
+def main(layer_counts):
+    application = QApplication.instance() or QApplication(sys.argv)
+
+    # Resolves the circular imports between the ui modules
+    import src.ui.window
+
+    print("{:>7} {:>8} {:>13} {:>15} {:>12} {:>13}".format(
+        "layers", "matches", "update (ms)", "per-item (ms)",
+        "pan (ms)", "zoom (ms)"))
+
+    for layer_count in layer_counts:
+        # The layers report their memory while loading
+        with contextlib.redirect_stdout(io.StringIO()):
+            graphics_view = make_view(layer_count)
+
+        def pan(i):
+            graphics_view.setTranslation(
+                graphics_view.translation() + QPointF(3, 2))
+
+        def zoom(i):
+            graphics_view.setScale(
+                graphics_view.scale() * (1.02 if i % 2 == 0 else 1 / 1.02),
+                QPointF(640, 400))
+
+        # The cost of moving everything, and of the frames that follow
+        update_ms = measure(graphics_view, pan, render=False)
+        per_item_ms = measure(graphics_view, lambda i: reposition_items(
+            graphics_view, QPointF(3, 2)), render=False)
+        pan_ms = measure(graphics_view, pan)
+        zoom_ms = measure(graphics_view, zoom)
+
+        print("{:>7} {:>8} {:>13.3f} {:>15.3f} {:>12.2f} {:>13.2f}".format(
+            layer_count, MatchesPerLayer * max(0, layer_count - 1),
+            update_ms, per_item_ms, pan_ms, zoom_ms))
+
+    application.processEvents()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1, 8, 32])
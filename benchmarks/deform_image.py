@@ -0,0 +1,93 @@
+#
+# Benchmark of `conover.deformImage` against the original implementation,
+# which interpolated every channel separately with `scipy.interpolate.griddata`
+#
+#   python -m benchmarks.deform_image [size ...]
+#
+
+import sys
+import time
+
+import numpy as np
+from scipy import interpolate
+
+import src.backend.conover as conover
+
+
+def deform_image_griddata(image, coeffx, coeffy):
+    image = image.astype(np.float32)
+
+    width  = image.shape[1]
+    height = image.shape[0]
+
+    result = np.zeros((height, width, 4))
+
+    grid_x, grid_y = np.meshgrid(
+        np.arange(width), np.arange(height))
+
+    grid_x_norm = (grid_x / width - 0.5).flatten()
+    grid_y_norm = (grid_y / height - 0.5).flatten()
+
+    apr_x = conover.bilinear_function(
+        np.hstack((grid_x_norm, grid_y_norm)), *(coeffx))
+
+    apr_y = conover.bilinear_function(
+        np.hstack((grid_x_norm, grid_y_norm)), *(coeffy))
+
+    for j in range(result.shape[2]):
+        interpolated = interpolate.griddata(
+            np.vstack((apr_x.flatten(), apr_y.flatten())).T,
+            image[:,:,j].flatten(),
+            np.vstack((grid_x.flatten(), grid_y.flatten())).T
+        )
+
+        interpolated = interpolated.reshape(result.shape[:2])
+        interpolated[np.isnan(interpolated)] = 0
+        result[:,:,j] = interpolated
+
+    return result
+
+
+def make_case(size):
+    # Smooth content, so both interpolation schemes should agree closely
+    grid_y, grid_x = np.mgrid[0:size, 0:size].astype(np.float32)
+
+    image = np.ones((size, size, 4), dtype=np.float32)
+    image[:,:,0] = np.sin(grid_x / 13) * 0.5 + 0.5
+    image[:,:,1] = np.cos(grid_y / 17) * 0.5 + 0.5
+    image[:,:,2] = grid_x / size
+
+    coeffx = (size / 2 + 3.5, size * 1.02, size * 0.01, size * 0.02)
+    coeffy = (size / 2 - 2.25, -size * 0.015, size * 0.98, size * 0.01)
+
+    return image, coeffx, coeffy
+
+
+def measure(func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start_time) * 1_000
+
+
+def main(sizes):
+    print("{:>6} {:>14} {:>12} {:>9} {:>12}".format(
+        "size", "griddata (ms)", "remap (ms)", "speedup", "max diff"))
+
+    for size in sizes:
+        image, coeffx, coeffy = make_case(size)
+
+        expected, griddata_ms = measure(deform_image_griddata, image, coeffx, coeffy)
+        result, remap_ms = measure(conover.deformImage, image, coeffx, coeffy)
+
+        # Only compare the interior, the old path leaves the border
+        # of the convex hull undefined
+        inside = (expected[:,:,3] > 0.999) & (result[:,:,3] > 0.999)
+        diff = np.abs(expected[inside] - result[inside])
+
+        print("{:>6} {:>14.0f} {:>12.1f} {:>8.0f}x {:>12.2e}".format(
+            size, griddata_ms, remap_ms, griddata_ms / remap_ms,
+            diff.max() if diff.size > 0 else np.nan))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [128, 256, 512])
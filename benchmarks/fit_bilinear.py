@@ -0,0 +1,114 @@
+#
+# Micro-benchmark of the closed-form `conover.fit_bilinear` against the
+# original implementation, which fitted every iteration with
+# `scipy.optimize.curve_fit`
+#
+#   python -m benchmarks.fit_bilinear [point_count ...]
+#
+
+import sys
+import time
+
+import numpy as np
+from scipy import optimize
+
+import src.backend.conover as conover
+
+
+def fit_bilinear_curve_fit(xdata, ydata, target_xdata, target_ydata, iteration_count = 20, threshold = 1 / 3):
+    if len(xdata) <= 4 or len(ydata) <= 4:
+        return -1, 0, None, None
+
+    fitfunc = conover.bilinear_function
+
+    xydata = np.hstack((xdata, ydata))
+
+    xoptimal, _ = optimize.curve_fit(fitfunc, xydata, target_xdata)
+    yoptimal, _ = optimize.curve_fit(fitfunc, xydata, target_ydata)
+
+    xdisparities = np.abs(fitfunc(xydata, *xoptimal) - target_xdata)
+    ydisparities = np.abs(fitfunc(xydata, *yoptimal) - target_ydata)
+
+    thresholds = np.geomspace(20, threshold, iteration_count)
+
+    i = -1
+    point_count = 0
+    for threshold in thresholds:
+        i += 1
+        xindices = np.squeeze(np.where(xdisparities < threshold))
+        yindices = np.squeeze(np.where(ydisparities < threshold))
+
+        point_count = len(xindices)
+        if len(xindices) <= 4 or len(yindices) <= 4:
+            break
+
+        good_xdata = xydata[np.hstack((xindices, xindices + len(xdata)))]
+        good_ydata = xydata[np.hstack((yindices, yindices + len(ydata)))]
+
+        xoptimal, _ = optimize.curve_fit(
+            fitfunc, good_xdata, target_xdata[xindices], p0 = xoptimal)
+        yoptimal, _ = optimize.curve_fit(
+            fitfunc, good_ydata, target_ydata[yindices], p0 = yoptimal)
+
+        xdisparities = np.abs(
+            fitfunc(xydata, *xoptimal) - target_xdata)
+        ydisparities = np.abs(
+            fitfunc(xydata, *yoptimal) - target_ydata)
+
+    return (
+        thresholds[i],
+        point_count,
+        xoptimal,
+        yoptimal
+    )
+
+
+def make_case(point_count, seed = 0):
+    rng = np.random.default_rng(seed)
+
+    # Normalized template keypoints, mapped to reference pixels by a bilinear
+    # function with some noise and 20% outliers, like conover() produces
+    x = rng.uniform(-0.5, 0.5, point_count)
+    y = rng.uniform(-0.5, 0.5, point_count)
+
+    target_x = 1000 + 2000 * x + 15 * y + 30 * x * y + rng.normal(0, 0.05, point_count)
+    target_y = 800 - 10 * x + 1600 * y + 20 * x * y + rng.normal(0, 0.05, point_count)
+
+    outliers = rng.random(point_count) < 0.2
+    target_x[outliers] += rng.uniform(-30, 30, outliers.sum())
+    target_y[outliers] += rng.uniform(-30, 30, outliers.sum())
+
+    return x, y, target_x, target_y
+
+
+def measure(func, *args, repeat = 5):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func(*args, threshold = 1 / 5, iteration_count = 20)
+        timings.append((time.perf_counter() - start_time) * 1_000)
+    return result, min(timings)
+
+
+def main(point_counts):
+    print("{:>7} {:>15} {:>13} {:>9} {:>9} {:>12}".format(
+        "points", "curve_fit (ms)", "closed (ms)", "speedup", "same fit", "coeff diff"))
+
+    for point_count in point_counts:
+        case = make_case(point_count)
+
+        expected, curve_fit_ms = measure(fit_bilinear_curve_fit, *case)
+        result, closed_ms = measure(conover.fit_bilinear, *case)
+
+        same = expected[:2] == result[:2]
+        diff = max(
+            np.abs(expected[2] - result[2]).max(),
+            np.abs(expected[3] - result[3]).max())
+
+        print("{:>7} {:>15.2f} {:>13.2f} {:>8.0f}x {:>9} {:>12.2e}".format(
+            point_count, curve_fit_ms, closed_ms, curve_fit_ms / closed_ms,
+            str(same), diff))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000])
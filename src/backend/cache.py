@@ -0,0 +1,172 @@
+from concurrent import futures
+
+import threading
+import collections
+
+import numpy as np
+
+import src.backend.conover as conover
+
+class ReferenceCache:
+    """
+    Caches the preprocessing of a group's reference layer that does not depend
+    on the template being aligned, so that it is shared by all templates.
+
+    Entries only depend on the pixels and are keyed on the layer and its pixel
+    generation, a stale entry is recomputed on first use. Entries are computed
+    outside of the lock, when two threads miss the same entry the first result
+    is kept.
+    """
+
+    # Amount of phase images of different reference regions that are kept
+    MaxPhaseImages = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._phase_images = collections.OrderedDict()
+
+
+    def clear(self):
+        # Swaps in empty containers instead of taking the lock, so clearing
+        # never waits for a computation
+        self._entries = {}
+        self._phase_images = collections.OrderedDict()
+
+
+    def _entry(self, layer, name, compute):
+        key = (layer, layer.pixelGeneration())
+        entries = self._entries
+
+        with self._lock:
+            entry = entries.get(name)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+
+        value = compute()
+
+        with self._lock:
+            entry = entries.get(name)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+
+            entries[name] = (key, value)
+            return value
+
+
+    def pixels(self, layer):
+        """
+        The RGB pixels of the layer as float32
+        """
+        return self._entry(layer, "pixels", lambda:
+            layer.fullResolutionPixels().astype(np.float32))
+
+
+    def luminance(self, layer):
+        """
+        The sum of the RGB channels, as used for finding control-point pairs
+        """
+        return self._entry(layer, "luminance", lambda:
+            self.pixels(layer).sum(2))
+
+
+    def features(self, layer):
+        """
+        The SIFT keypoints and descriptors of the layer
+        """
+        return self._entry(layer, "features", lambda:
+            conover.detect_features(layer.fullResolutionPixels()))
+
+
+    def phaseImage(self, layer, x, y, width, height):
+        """
+        The whitened phase image of a region of the luminance
+        """
+        key = (layer, layer.pixelGeneration(), x, y, width, height)
+        phase_images = self._phase_images
+
+        with self._lock:
+            if key in phase_images:
+                phase_images.move_to_end(key)
+                return phase_images[key]
+
+        luminance = self.luminance(layer)
+        phase = conover.phase_image(luminance[y:y+height, x:x+width])
+
+        with self._lock:
+            if key in phase_images:
+                return phase_images[key]
+
+            phase_images[key] = phase
+            if len(phase_images) > ReferenceCache.MaxPhaseImages:
+                phase_images.popitem(last=False)
+
+            return phase
+
+
+class EvaluationCache:
+    """
+    A bounded LRU cache of candidate evaluations, so that parameters that are
+    proposed more than once are only evaluated once.
+
+    Keys should contain everything the value depends on, including the
+    generation of the layers involved, stale entries are never hit and are
+    evicted like any other.
+
+    A computation that is still running is shared as well, asking for the
+    same key from another thread waits for it instead of computing it again.
+    """
+
+    MaxEntries = 256
+
+    def __init__(self, max_entries = None):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries or EvaluationCache.MaxEntries
+        self._entries = collections.OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+
+
+    def hits(self):
+        return self._hits
+
+    def misses(self):
+        return self._misses
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def entry(self, key, compute):
+        """
+        Returns the value of the key, computing it with `compute()` on a miss
+        """
+        with self._lock:
+            future = self._entries.get(key)
+            owner = future is None
+
+            if owner:
+                self._misses += 1
+
+                future = futures.Future()
+                self._entries[key] = future
+                if len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+
+        if owner:
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                # Failures are not cached, the next request retries
+                with self._lock:
+                    if self._entries.get(key) is future:
+                        del self._entries[key]
+                future.set_exception(e)
+
+        return future.result()
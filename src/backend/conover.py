@@ -5,16 +5,20 @@
 #   Dr. Matthias Alfeld (TU Delft)
 #
 
+from concurrent import futures
+
 import numpy as np
 
-from scipy import optimize
-from scipy import interpolate
+from scipy.fft import rfft2, irfft2, next_fast_len
 
 import cv2
 
 import functools
 import time
 
+import src.util.threads as threads
+from src.util.shared import SharedArray, attachSharedArray
+
 # https://stackoverflow.com/a/20924212/14647075
 def timeit(func):
     @functools.wraps(func)
@@ -114,6 +118,25 @@ def compute_modulus(image, order):
 
 
 # @timeit
+def apply_mask(pixels, mask):
+    """
+    Zeroes the pixels where the mask is set.
+
+    Parameters
+    ----------
+    pixels : (N, M, 3) array_like
+             RGB image
+    mask : (N, M) array_like
+           uint8 mask, non-zero where the pixel is masked out
+
+    Returns
+    -------
+    masked : (N, M, 3) array_like
+             The masked pixels
+    """
+    return pixels * (mask == 0)[:,:,np.newaxis]
+
+
 def identify_control_points(image, windowsize):
     """
     Identifies the control-points from the modulus of the wavelet
@@ -150,8 +173,34 @@ def identify_control_points(image, windowsize):
     return pairs if len(pairs.shape) != 0 else []
 
 
+def detect_features(image, mask = None):
+    """
+    Detects the SIFT keypoints and descriptors of an image, as used by
+    `approximate_transformation`.
+
+    Parameters
+    ----------
+    image : (N, M, P) array_like
+            The image, pixel values should be between 0 and 1
+    mask : (N, M) array_like
+           Features will only be found where the mask is 255
+    
+    Returns
+    -------
+    keypoints : cv2.KeyPoint[]
+                The detected keypoints
+    descriptors : (K, 128) array_like
+                  The descriptor of every keypoint
+    """
+    image_norm = (image - image.min()) / (image.max() - image.min())
+    image_norm = (image_norm * 255).astype(dtype=np.uint8, subok=True, copy=False)
+
+    sift = cv2.SIFT.create(0, 3, 0.04, 10, 1.6) # Using Lowe's parameters
+    return sift.detectAndCompute(image_norm, mask)
+
+
 # @timeit
-def approximate_transformation(reference, template, template_mask = None):
+def approximate_transformation(reference, template, template_mask = None, reference_features = None):
     """
     Attempts to find an initial transformation of the template to the reference
     using SIFT.
@@ -165,21 +214,20 @@ def approximate_transformation(reference, template, template_mask = None):
     template_mask : (Q, R) array_like
                     Mask for the template image, features will only be found
                     where the mask is 255.
+    reference_features : (cv2.KeyPoint[], (K, 128) array_like) or None
+                         Precomputed `detect_features(reference)`, the
+                         reference image is not used when given
     
     Returns
     -------
     transformation : (2, 3) array_like
                      Returns a matrix representing a 2D affine transformation.
     """
-    reference_norm = (reference - reference.min()) / (reference.max() - reference.min())
-    template_norm = (template - template.min()) / (template.max() - template.min())
-
-    reference_norm = (reference_norm * 255).astype(dtype=np.uint8, subok=True, copy=False)
-    template_norm = (template_norm * 255).astype(dtype=np.uint8, subok=True, copy=False)
+    if reference_features is None:
+        reference_features = detect_features(reference)
 
-    sift = cv2.SIFT.create(0, 3, 0.04, 10, 1.6) # Using Lowe's parameters
-    kp_ref, desc_ref = sift.detectAndCompute(reference_norm, None)
-    kp_temp, desc_temp = sift.detectAndCompute(template_norm, template_mask)
+    kp_ref, desc_ref = reference_features
+    kp_temp, desc_temp = detect_features(template, template_mask)
 
     bf_matcher = cv2.BFMatcher.create()
     matches = sorted(
@@ -227,14 +275,8 @@ def transform_template_affine(reference, template, matrix):
     width = int(np.dot(matrix[0], (template.shape[1], template.shape[0], 1)))
     height = int(np.dot(matrix[1], (template.shape[1], template.shape[0], 1)))
 
-    offset = matrix[:, 2]
-    new_shape = (
-        template.shape[0] * matrix[1, 1],
-        template.shape[1] * matrix[0, 0]
-    )
-
-    template_minx = int(max(0, offset[0]))
-    template_miny = int(max(0, offset[1]))
+    template_minx, template_miny, crop_width, crop_height = affine_crop(
+        reference.shape, template.shape, matrix)
 
     new_template = cv2.warpAffine(
         template.astype(np.float32),
@@ -243,18 +285,59 @@ def transform_template_affine(reference, template, matrix):
     ).astype(
         dtype=np.float32, subok=True, copy=False
     )[
-        template_miny:int(min(reference.shape[0], offset[1] + new_shape[0])),
-        template_minx:int(min(reference.shape[1], offset[0] + new_shape[1]))
+        template_miny:template_miny+crop_height,
+        template_minx:template_minx+crop_width
     ]
 
-    new_reference = reference.astype(np.float32)[
+    new_reference = reference[
         template_miny:template_miny+new_template.shape[0],
         template_minx:template_minx+new_template.shape[1]
-    ]
+    ].astype(dtype=np.float32, subok=True, copy=False)
 
     return new_reference, new_template
 
 
+def affine_crop(reference_shape, template_shape, matrix):
+    """
+    Computes the region of the reference image that `transform_template_affine`
+    crops out for the given transformation.
+
+    Returns
+    -------
+    x, y, width, height : int
+                          The region, the width and height are upper bounds
+                          that may still be clipped by the transformed template
+    """
+    offset = matrix[:, 2]
+    new_shape = (
+        template_shape[0] * matrix[1, 1],
+        template_shape[1] * matrix[0, 0]
+    )
+
+    minx = int(max(0, offset[0]))
+    miny = int(max(0, offset[1]))
+
+    return (
+        minx,
+        miny,
+        max(0, int(min(reference_shape[1], offset[0] + new_shape[1])) - minx),
+        max(0, int(min(reference_shape[0], offset[1] + new_shape[0])) - miny)
+    )
+
+
+def downscale(image, factor):
+    """
+    Downscales an image by the given factor using area interpolation, the
+    image is returned as is for a factor of 1.
+    """
+    if factor == 1:
+        return image
+
+    return cv2.resize(
+        image, None, fx=1 / factor, fy=1 / factor,
+        interpolation=cv2.INTER_AREA)
+
+
 def upscale_region(image, center, halfsize, factor):
     """
     Upscales the region of size `2 * halfsize` centered around
@@ -292,18 +375,177 @@ def upscale_region(image, center, halfsize, factor):
         interpolation=cv2.INTER_CUBIC)
 
 
-# @timeit
-def find_control_point_pairs(reference, template, control_point_xys, search_region_size, control_point_region_size, scale_factor):
+def normalized_cross_correlation(search_regions, control_point_regions):
     """
-    Finds the control-point pairs between the reference and template
-    images.
+    Computes the normalized cross-correlation surfaces of a stack of
+    control-point regions within their search regions, equivalent to
+    calling `cv2.matchTemplate` with `cv2.TM_CCORR_NORMED` on every pair.
+
+    The correlations are computed for the whole stack at once in the
+    frequency domain, the normalization uses integral images.
 
     Parameters
     ----------
-    reference : (N, M, 4) array_like
-                The reference image
-    template : (L, K, 4) array_like
-               The template image
+    search_regions : (K, N, M) array_like
+                     The regions to search in
+    control_point_regions : (K, P, Q) array_like
+                            The regions to search for, P <= N and Q <= M
+
+    Returns
+    -------
+    ccorr : (K, N - P + 1, M - Q + 1) array_like
+            The correlation surface of every pair
+    """
+    search_regions = np.asarray(search_regions, dtype=np.float32)
+    control_point_regions = np.asarray(control_point_regions, dtype=np.float32)
+
+    count, height, width = search_regions.shape
+    cp_height, cp_width = control_point_regions.shape[1:]
+
+    # Cross-correlation through the frequency domain, in single precision like
+    # OpenCV. The regions are zero-padded to a size the FFT is fast for, the
+    # valid part of the circular correlation does not wrap around
+    shape = (next_fast_len(height, True), next_fast_len(width, True))
+
+    padded = np.zeros((2, count) + shape, dtype=np.float32)
+    padded[0, :, :height, :width] = search_regions
+    padded[1, :, :cp_height, :cp_width] = control_point_regions
+
+    spectra = rfft2(padded)
+    ccorr = irfft2(spectra[0] * np.conj(spectra[1]), s=shape)[
+        :, :height - cp_height + 1, :width - cp_width + 1]
+
+    # Energy of the search region under every placement of the control-point
+    # region, using an integral image
+    integral = np.zeros((count, height + 1, width + 1))
+    integral[:, 1:, 1:] = search_regions
+    integral **= 2
+    np.cumsum(integral, 1, out=integral)
+    np.cumsum(integral, 2, out=integral)
+
+    energy = (integral[:, cp_height:, cp_width:]
+        - integral[:, :-cp_height, cp_width:]
+        - integral[:, cp_height:, :-cp_width]
+        + integral[:, :-cp_height, :-cp_width])
+
+    norm = np.sqrt(np.maximum(energy, 0))
+    norm *= np.sqrt(
+        (control_point_regions ** 2).sum((1, 2), dtype=np.float64))[:, None, None]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ccorr = ccorr / norm
+
+    # Same handling of (near) zero denominators as OpenCV
+    invalid = ~(np.abs(ccorr) < 1)
+    if invalid.any():
+        ccorr[invalid] = np.where(
+            np.abs(ccorr[invalid]) < 1.125, np.sign(ccorr[invalid]), 0)
+
+    return ccorr
+
+
+def _upscale_regions(regions, factor):
+    """
+    Upscales a stack of equally sized regions, identical to calling
+    `upscale_region` on each of them.
+    """
+    if factor == 1:
+        return regions
+
+    # cv2.resize treats the last axis as channels, recent versions of OpenCV
+    # support up to 128 of them
+    upscaled = [
+        cv2.resize(
+            np.ascontiguousarray(np.moveaxis(regions[i:i + 128], 0, -1)),
+            None, fx=factor, fy=factor,
+            interpolation=cv2.INTER_CUBIC)
+        for i in range(0, len(regions), 128)
+    ]
+
+    return np.concatenate([
+        np.moveaxis(region.reshape(region.shape[:2] + (-1,)), -1, 0)
+        for region in upscaled
+    ])
+
+
+def _match_control_point(reference, template, x, y, search_region_size, control_point_region_size, scale_factor, reference_x = None, reference_y = None):
+    """
+    Matches a single control-point, used for control-points whose regions
+    are cut off by the border of the images.
+
+    The search region is centered around (`reference_x`, `reference_y`),
+    which default to the control-point itself.
+
+    Returns the accepted point in the reference image or None.
+    """
+    if reference_x is None or reference_y is None:
+        reference_x, reference_y = x, y
+
+    search_region = (
+        upscale_region(
+            reference,
+            (reference_x, reference_y),
+            (search_region_size, search_region_size),
+            scale_factor))
+
+    if search_region is None:
+        return None
+
+    control_point_region = (
+        upscale_region(
+            template,
+            (x, y),
+            (control_point_region_size, control_point_region_size),
+            scale_factor))
+
+    if control_point_region is None:
+        return None
+
+    if (search_region.shape[0] < control_point_region.shape[0]
+        or search_region.shape[1] < control_point_region.shape[1]
+    ):
+        return None
+
+    ccorr = cv2.matchTemplate(
+        search_region,
+        control_point_region,
+        cv2.TM_CCORR_NORMED)
+
+    maxval = ccorr.max()
+    ccorr_no_max = ccorr[ccorr != maxval]
+    std = ccorr_no_max.std()
+
+    T1 = maxval >= 4 * std
+    T2 = (ccorr_no_max.shape[0] > 0
+        and maxval > (ccorr_no_max.max() + std))
+
+    if not (T1 and T2):
+        return None
+
+    ty, tx = np.unravel_index(np.argmax(ccorr), ccorr.shape)
+
+    return (
+        reference_x + tx / scale_factor - (search_region_size - control_point_region_size),
+        reference_y + ty / scale_factor - (search_region_size - control_point_region_size)
+    )
+
+
+def match_control_points(reference, template, control_point_xys, search_region_size, control_point_region_size, scale_factor, batch_size = 512, reference_xys = None, cancel_token = None):
+    """
+    Matches the regions around the control-points in the template image to
+    their search regions in the reference image.
+
+    Control-points whose regions lie fully inside both images are matched in
+    batches: the regions are stacked and the correlation surfaces, their
+    maxima and the acceptance tests are computed for the whole batch at once.
+    The remaining control-points are matched one by one.
+
+    Parameters
+    ----------
+    reference : (N, M) array_like
+                The (whitened) reference image
+    template : (L, K) array_like
+               The (whitened) template image
     control_point_xys : (P, 2)[]
                         The x and y coordinates of the
                         control-points relative to the template image
@@ -316,110 +558,273 @@ def find_control_point_pairs(reference, template, control_point_xys, search_regi
     scale_factor : scalar
                    The factor with which to scale the regions around
                    the control-points
-    
+    batch_size : int
+                 The maximum amount of control-points matched at once
+    reference_xys : (P, 2)[] or None
+                    The x and y coordinates in the reference image around
+                    which the search regions are centered, defaults to
+                    `control_point_xys`
+    cancel_token : threads.CancellationToken or None
+                   Checked after every batch, raises `threads.Cancelled`
+
     Returns
     -------
     keypoints_reference,
     keypoints_template : (Q, 2) array_like
                          The sub-pixel x and y coordinates of the keypoints
                          found in the reference and template images
-                         respectively, points of the same index in both arrays
-                         are pairs
+                         respectively, in the order of `control_point_xys`
     """
-    keypoints_reference = []
-    keypoints_template  = []
-
-    # Find the optimal sizes for both images
-    #   Reference first
-    optimal_width  = cv2.getOptimalDFTSize(reference.shape[1] + 10)
-    optimal_height = cv2.getOptimalDFTSize(reference.shape[0] + 10)
-    reference = cv2.copyMakeBorder(
-        reference,
-        0, optimal_height - reference.shape[0],
-        0, optimal_width  - reference.shape[1],
-        cv2.BORDER_CONSTANT,
-        value = 0
-    ).astype(dtype=np.float32, subok=True, copy=False)
-    
-    #  Template next
-    optimal_width  = cv2.getOptimalDFTSize(template.shape[1] + 10)
-    optimal_height = cv2.getOptimalDFTSize(template.shape[0] + 10)
-    template = cv2.copyMakeBorder(
-        template,
-        0, optimal_height - template.shape[0],
-        0, optimal_width  - template.shape[1],
+    control_point_xys = np.reshape(control_point_xys, (-1, 2))
+
+    accepted = np.zeros(len(control_point_xys), dtype=bool)
+    points = np.zeros((len(control_point_xys), 2))
+
+    if reference_xys is None:
+        reference_xys = control_point_xys
+    reference_xys = np.reshape(reference_xys, (-1, 2))
+
+    xs = control_point_xys[:, 0]
+    ys = control_point_xys[:, 1]
+    rxs = reference_xys[:, 0]
+    rys = reference_xys[:, 1]
+
+    # Control-points of which both regions can be cut out without clipping
+    inside = ((rxs - search_region_size >= 0)
+        & (rys - search_region_size >= 0)
+        & (rxs + search_region_size + 1 <= reference.shape[1])
+        & (rys + search_region_size + 1 <= reference.shape[0])
+        & (xs - control_point_region_size >= 0)
+        & (ys - control_point_region_size >= 0)
+        & (xs + control_point_region_size + 1 <= template.shape[1])
+        & (ys + control_point_region_size + 1 <= template.shape[0]))
+
+    if search_region_size < control_point_region_size:
+        inside[:] = False
+
+    search_windows = np.lib.stride_tricks.sliding_window_view(
+        reference, (2 * search_region_size + 1,) * 2)
+    control_point_windows = np.lib.stride_tricks.sliding_window_view(
+        template, (2 * control_point_region_size + 1,) * 2)
+
+    batched = np.flatnonzero(inside)
+    for start in range(0, len(batched), batch_size):
+        if cancel_token is not None:
+            cancel_token.check()
+
+        indices = batched[start:start + batch_size]
+
+        x = xs[indices]
+        y = ys[indices]
+        rx = rxs[indices]
+        ry = rys[indices]
+
+        ccorr = normalized_cross_correlation(
+            _upscale_regions(search_windows[
+                (ry - search_region_size).astype(int),
+                (rx - search_region_size).astype(int)
+            ], scale_factor),
+            _upscale_regions(control_point_windows[
+                (y - control_point_region_size).astype(int),
+                (x - control_point_region_size).astype(int)
+            ], scale_factor)
+        )
+        ccorr_width = ccorr.shape[2]
+        ccorr = ccorr.reshape(len(indices), -1)
+
+        maxval = ccorr.max(1)
+        no_max = ccorr != maxval[:, None]
+        count = no_max.sum(1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(no_max, ccorr, 0).sum(1) / count
+            std = np.sqrt(
+                np.where(no_max, (ccorr - mean[:, None]) ** 2, 0).sum(1) / count)
+
+        T1 = maxval >= 4 * std
+        T2 = ((count > 0)
+            & (maxval > np.where(no_max, ccorr, -np.inf).max(1) + std))
+
+        ty, tx = np.divmod(ccorr.argmax(1), ccorr_width)
+
+        accepted[indices] = T1 & T2
+        points[indices, 0] = rx + tx / scale_factor - (search_region_size - control_point_region_size)
+        points[indices, 1] = ry + ty / scale_factor - (search_region_size - control_point_region_size)
+
+    for n, i in enumerate(np.flatnonzero(~inside)):
+        if cancel_token is not None and n % batch_size == 0:
+            cancel_token.check()
+
+        point = _match_control_point(
+            reference, template, xs[i], ys[i],
+            search_region_size, control_point_region_size, scale_factor,
+            rxs[i], rys[i])
+
+        if point is not None:
+            accepted[i] = True
+            points[i] = point
+
+    if not accepted.any():
+        return np.array([]), np.array([])
+
+    return points[accepted], control_point_xys[accepted]
+
+
+def phase_image(image):
+    """
+    Whitens an image by keeping only the phase of its Fourier transform.
+
+    The image is first zero-padded to a size the DFT is efficient for, with
+    a margin of at least 10 pixels.
+
+    Parameters
+    ----------
+    image : (N, M) array_like
+            The image to whiten
+
+    Returns
+    -------
+    phase : (N', M') array_like
+            The float32 magnitude of the inverse transform of the phase
+    """
+    optimal_width  = cv2.getOptimalDFTSize(image.shape[1] + 10)
+    optimal_height = cv2.getOptimalDFTSize(image.shape[0] + 10)
+    image = cv2.copyMakeBorder(
+        image,
+        0, optimal_height - image.shape[0],
+        0, optimal_width  - image.shape[1],
         cv2.BORDER_CONSTANT,
         value = 0
     ).astype(dtype=np.float32, subok=True, copy=False)
-    
 
-    # Calculate the full-scale phase images for both
-    fft = cv2.dft(reference, flags = cv2.DFT_COMPLEX_OUTPUT)
+    fft = cv2.dft(image, flags = cv2.DFT_COMPLEX_OUTPUT)
     fft[:,:,0], fft[:,:,1] = cv2.polarToCart(
         None, cv2.phase(fft[:,:,0], fft[:,:,1]))
     ifft = cv2.idft(fft)
-    reference = cv2.magnitude(ifft[:,:,0], ifft[:,:,1])
+    return cv2.magnitude(ifft[:,:,0], ifft[:,:,1])
 
-    fft = cv2.dft(template, flags = cv2.DFT_COMPLEX_OUTPUT)
-    fft[:,:,0], fft[:,:,1] = cv2.polarToCart(
-        None, cv2.phase(fft[:,:,0], fft[:,:,1]))
-    ifft = cv2.idft(fft)
-    template = cv2.magnitude(ifft[:,:,0], ifft[:,:,1])
-
-
-    for x, y in control_point_xys:
-        search_region = (
-            upscale_region(
-                reference,
-                (x, y),
-                (search_region_size, search_region_size),
-                scale_factor))
-        
-        if search_region is None:
-            continue
-        
-        control_point_region = (
-            upscale_region(
-                template,
-                (x, y),
-                (control_point_region_size, control_point_region_size),
-                scale_factor))
-        
-        if control_point_region is None:
-            continue
-        
-        if (search_region.shape[0] < control_point_region.shape[0]
-            or search_region.shape[1] < control_point_region.shape[1]
-        ):
-            continue
 
-        ccorr = cv2.matchTemplate(
-            search_region,
-            control_point_region,
-            cv2.TM_CCORR_NORMED)
-        
-        maxval = ccorr.max()
-        ccorr_no_max = ccorr[ccorr != maxval]
-        std = ccorr_no_max.std()
+def _match_control_points_shared(reference_handle, template_handle, control_point_xys, *args, **kwargs):
+    """
+    Runs `match_control_points` in a worker process on images that were
+    placed in shared memory.
+    """
+    with attachSharedArray(reference_handle) as reference, \
+        attachSharedArray(template_handle) as template:
+        return match_control_points(reference, template, control_point_xys, *args, **kwargs)
+
 
-        T1 = maxval >= 4 * std
-        T2 = (ccorr_no_max.shape[0] > 0
-            and maxval > (ccorr_no_max.max() + std))
-        
-        if T1 and T2:
-            ty, tx = np.unravel_index(np.argmax(ccorr), ccorr.shape)
-
-            accepted_point = (
-                x + tx / scale_factor - (search_region_size - control_point_region_size),
-                y + ty / scale_factor - (search_region_size - control_point_region_size)
+# @timeit
+def find_control_point_pairs(reference, template, control_point_xys, search_region_size, control_point_region_size, scale_factor, workers = 1, reference_phase = None, reference_xys = None, cancel_token = None):
+    """
+    Finds the control-point pairs between the reference and template
+    images.
+
+    Parameters
+    ----------
+    reference : (N, M, 4) array_like
+                The reference image
+    template : (L, K, 4) array_like
+               The template image
+    control_point_xys : (P, 2)[]
+                        The x and y coordinates of the
+                        control-points relative to the template image
+    search_region_size : int
+                         The size of the regions around the
+                         control-points in the reference image
+    control_point_region_size : int
+                                The size of the regions around the
+                                control-points in the template image
+    scale_factor : scalar
+                   The factor with which to scale the regions around
+                   the control-points
+    workers : int
+              The amount of chunks the control-points are split into to be
+              matched in parallel by the process pool, 1 matches them in the
+              calling thread
+    reference_phase : (N', M') array_like or None
+                      Precomputed `phase_image(reference)`, the reference
+                      image is not used when given
+    reference_xys : (P, 2)[] or None
+                    The x and y coordinates in the reference image around
+                    which the search regions are centered, defaults to
+                    `control_point_xys`
+    cancel_token : threads.CancellationToken or None
+                   Checked while matching, raises `threads.Cancelled`
+    
+    Returns
+    -------
+    keypoints_reference,
+    keypoints_template : (Q, 2) array_like
+                         The sub-pixel x and y coordinates of the keypoints
+                         found in the reference and template images
+                         respectively, points of the same index in both arrays
+                         are pairs
+    """
+    if reference_phase is None:
+        reference_phase = phase_image(reference)
+    template_phase = phase_image(template)
+
+    control_point_xys = np.reshape(control_point_xys, (-1, 2))
+    if reference_xys is None:
+        reference_xys = control_point_xys
+    reference_xys = np.reshape(reference_xys, (-1, 2))
+    args = (search_region_size, control_point_region_size, scale_factor)
+
+    # Parallelizing only pays off for a decent amount of points per worker
+    chunk_count = min(workers, len(control_point_xys) // 256)
+
+    if chunk_count <= 1:
+        return match_control_points(
+            reference_phase, template_phase, control_point_xys, *args,
+            reference_xys=reference_xys, cancel_token=cancel_token)
+
+    with SharedArray(reference_phase) as shared_reference, \
+        SharedArray(template_phase) as shared_template:
+        jobs = [
+            threads.ProcessPool.getInstance().submit(
+                _match_control_points_shared,
+                shared_reference.handle(),
+                shared_template.handle(),
+                chunk,
+                *args,
+                reference_xys=reference_chunk
             )
-        
-            keypoints_reference.append(accepted_point)
-            keypoints_template.append((x, y))
+            for chunk, reference_chunk in zip(
+                np.array_split(control_point_xys, chunk_count),
+                np.array_split(reference_xys, chunk_count))
+        ]
+
+        # A running chunk cannot be interrupted, but the chunks that have not
+        # started yet are dropped
+        pending = jobs
+        while len(pending) > 0:
+            _, pending = futures.wait(pending, timeout=0.1)
+
+            if cancel_token is not None and len(pending) > 0:
+                try:
+                    cancel_token.check()
+                except threads.Cancelled:
+                    for job in pending:
+                        job.cancel()
+                    raise
+
+        # The chunks are consecutive, merging them in submission order keeps
+        # the order of `control_point_xys`
+        results = [
+            job.result() for job in jobs
+        ]
+
+    results = [
+        result for result in results if len(result[0]) > 0
+    ]
+
+    if len(results) == 0:
+        return np.array([]), np.array([])
 
     return (
-        np.array(keypoints_reference),
-        np.array(keypoints_template)
+        np.concatenate([result[0] for result in results]),
+        np.concatenate([result[1] for result in results])
     )
 
 
@@ -463,15 +868,35 @@ def fit_bilinear(xdata, ydata, target_xdata, target_ydata, iteration_count = 20,
     if len(xdata) <= 4 or len(ydata) <= 4:
         return -1, 0, None, None
 
-    fitfunc = bilinear_function
-
-    xydata = np.hstack((xdata, ydata))
-
-    xoptimal, _ = optimize.curve_fit(fitfunc, xydata, target_xdata)
-    yoptimal, _ = optimize.curve_fit(fitfunc, xydata, target_ydata)
-
-    xdisparities = np.abs(fitfunc(xydata, *xoptimal) - target_xdata)
-    ydisparities = np.abs(fitfunc(xydata, *yoptimal) - target_ydata)
+    # The bilinear function is linear in its parameters, so every fit is a
+    # linear least-squares problem over rows of the same design matrix.
+    # Precomputing the outer product of every row turns the normal equations
+    # of any subset of points into a single matrix product, the x and y
+    # mappings are solved for together
+    design = np.column_stack((
+        np.ones(len(xdata)),
+        xdata,
+        ydata,
+        xdata * ydata
+    ))
+    products = (design[:, :, None] * design[:, None, :]).reshape(-1, 16)
+    targets = np.column_stack((target_xdata, target_ydata))
+
+    def fit(masks):
+        weights = masks.astype(np.float64)
+        try:
+            return np.linalg.solve(
+                (weights.T @ products).reshape(2, 4, 4),
+                ((weights * targets).T @ design)[..., None]
+            )[..., 0].T
+        except np.linalg.LinAlgError:
+            return np.column_stack([
+                np.linalg.lstsq(design[mask], target[mask], rcond=None)[0]
+                for mask, target in zip(masks.T, targets.T)
+            ])
+
+    optimal = fit(np.ones(targets.shape, dtype=bool))
+    disparities = np.abs(design @ optimal - targets)
 
     thresholds = np.geomspace(20, threshold, iteration_count)
 
@@ -479,26 +904,18 @@ def fit_bilinear(xdata, ydata, target_xdata, target_ydata, iteration_count = 20,
     point_count = 0
     for threshold in thresholds:
         i += 1
-        xindices = np.squeeze(np.where(xdisparities < threshold))
-        yindices = np.squeeze(np.where(ydisparities < threshold))
+        masks = disparities < threshold
+        xcount, ycount = masks.sum(0)
 
-        point_count = len(xindices)
-        if len(xindices) <= 4 or len(yindices) <= 4:
+        point_count = xcount
+        if xcount <= 4 or ycount <= 4:
             break
 
-        good_xdata = xydata[np.hstack((xindices, xindices + len(xdata)))]
-        good_ydata = xydata[np.hstack((yindices, yindices + len(ydata)))]
+        optimal = fit(masks)
+        disparities = np.abs(design @ optimal - targets)
 
-        xoptimal, _ = optimize.curve_fit(
-            fitfunc, good_xdata, target_xdata[xindices], p0 = xoptimal)
-        yoptimal, _ = optimize.curve_fit(
-            fitfunc, good_ydata, target_ydata[yindices], p0 = yoptimal)
-
-        xdisparities = np.abs(
-            fitfunc(xydata, *xoptimal) - target_xdata)
-        ydisparities = np.abs(
-            fitfunc(xydata, *yoptimal) - target_ydata)
-    
+    xoptimal = optimal[:, 0]
+    yoptimal = optimal[:, 1]
     
     if (threshold < 0
         or xoptimal is None
@@ -550,7 +967,12 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
     search_region_size = 20, control_point_region_size = 12,
     scale_factor = 3,
     control_points = None,
-    transform = None
+    transform = None,
+    workers = 1,
+    reference_phase_at = None,
+    pyramid_levels = 1,
+    refine_margin = 4,
+    cancel_token = None
 ):
     """
     Applies the algorithm described by Conover et al. in their 2015 paper.
@@ -559,6 +981,12 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
     The final mapping takes a relatively long time, so it has been extracted
     into `deform_image`
 
+    With more than one pyramid level the images are registered coarse to
+    fine. The coarsest level is matched with the full search regions, which
+    then cover a larger part of the full resolution images. Every finer level
+    only searches `refine_margin` pixels around the location predicted by the
+    bilinear mapping of the level above it.
+
     Parameters
     ----------
     reference : (N, M, 3) array_like
@@ -566,7 +994,8 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
     template : (N, M, 3) array_like
                Template image
     mask : (N, M) array_like
-           The mask applied to the template image
+           The uint8 mask of the template image, non-zero where the
+           template is masked out
     order : int
             The order of the filter
     windowsize : int
@@ -580,6 +1009,23 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
     scale_factor : scalar
                    The factor with which to scale the regions around
                    the control-points
+    workers : int
+              The amount of processes the control-point matching is spread
+              over, see `find_control_point_pairs`
+    reference_phase_at : callable(int, int, int, int) or None
+                         Returns the `phase_image` of the region at the given
+                         x, y, width and height of the summed reference
+                         channels, allows the caller to cache it
+    pyramid_levels : int
+                     The amount of resolution levels, each level halves the
+                     resolution of the previous one, 1 only registers at full
+                     resolution
+    refine_margin : int
+                    The difference between the search region and
+                    control-point region sizes on all but the coarsest level
+    cancel_token : threads.CancellationToken or None
+                   Checked between the steps and while matching, raises
+                   `threads.Cancelled`
     
     Returns
     -------
@@ -604,6 +1050,9 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
                              are pairs
         aligned_template : (M, P, 3) array_like
                            Roughly aligned template image
+        level_timings : (scalar)[]
+                        The seconds spent matching and fitting at every
+                        pyramid level, from coarse to fine
     }
     """
     # Apply the algorithm, each step in the paper roughly corresponds to
@@ -616,7 +1065,8 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
         "keypoints_reference": None,
         "keypoints_template": None,
         "aligned_template": None,
-        "point_count": 0
+        "point_count": 0,
+        "level_timings": []
     }
 
     if control_points is None:
@@ -626,12 +1076,22 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
     if len(control_points) <= 0:
         return result
 
+    if cancel_token is not None:
+        cancel_token.check()
+
+    # The coarsest level should still fit a few search regions
+    pyramid_levels = int(np.clip(
+        np.log2(min(template.shape[:2]) / (4 * search_region_size)) + 1,
+        1, pyramid_levels))
+
     if transform is None:
+        coarsest_scale = 2 ** (pyramid_levels - 1)
         transform = approximate_transformation(
-            reference,
-            template,
-            np.uint8(255 - mask * 255)
+            downscale(reference, coarsest_scale),
+            downscale(template, coarsest_scale),
+            None if mask is None else downscale(255 - mask, coarsest_scale)
         )
+        transform[:, 2] *= coarsest_scale
     result["transform"] = transform
 
     new_reference, new_template = transform_template_affine(
@@ -659,48 +1119,187 @@ def conover(reference, template, mask = None, order = 3, windowsize = 12,
         control_points,
         transform[:, :2].T
     )
-    
-    keypoints_reference, keypoints_template = find_control_point_pairs(
-        new_reference[:,:,:3].sum(2),
-        new_template[:,:,:3].sum(2),
-        control_points,
-        search_region_size,
-        control_point_region_size,
-        scale_factor
-    )
 
-    if (len(np.squeeze(keypoints_reference)) == 0
-        or len(np.squeeze(keypoints_template)) == 0
-    ):
-        return result
-    
-    result["keypoints_reference"] = keypoints_reference
-    result["keypoints_template"] = keypoints_template
-
-    kp_temp_norm = keypoints_template / new_template.shape[:2][::-1] - 0.5
-
-    fitness, point_count, xoptimal, yoptimal = fit_bilinear(
-        kp_temp_norm[:, 0],
-        kp_temp_norm[:, 1],
-        keypoints_reference[:, 0],
-        keypoints_reference[:, 1],
-        threshold = 1 / 5,
-        iteration_count = 20
-    )
+    if cancel_token is not None:
+        cancel_token.check()
+
+    reference_luminance = new_reference[:,:,:3].sum(2)
+    template_luminance = new_template[:,:,:3].sum(2)
+    template_size = np.array(new_template.shape[:2][::-1])
+
+    reference_pyramid = [reference_luminance]
+    template_pyramid = [template_luminance]
+    for _ in range(pyramid_levels - 1):
+        reference_pyramid.append(cv2.pyrDown(reference_pyramid[-1]))
+        template_pyramid.append(cv2.pyrDown(template_pyramid[-1]))
+
+    # Every level is matched with the bilinear mapping of the coarser level as
+    # prior, so only the finest level matches without one
+    coefficients = None
+    for level in range(pyramid_levels - 1, -1, -1):
+        level_start = time.perf_counter()
+        level_scale = 2 ** level
+
+        level_points = control_points / level_scale
+        if level > 0:
+            # A coarse mapping does not need every control-point, keep one
+            # for every control-point region sized cell
+            _, indices = np.unique(
+                np.floor(level_points / control_point_region_size),
+                axis=0, return_index=True)
+            level_points = np.round(level_points[np.sort(indices)])
+
+        reference_xys = None
+        level_search_region_size = search_region_size
+        if coefficients is not None:
+            normalized = level_points * level_scale / template_size - 0.5
+            normalized = np.concatenate((normalized[:, 0], normalized[:, 1]))
+            reference_xys = np.round(np.column_stack((
+                bilinear_function(normalized, *coefficients[0]),
+                bilinear_function(normalized, *coefficients[1])
+            )) / level_scale)
+            level_search_region_size = control_point_region_size + refine_margin
+
+        reference_phase = None
+        if level == 0 and reference_phase_at is not None:
+            minx, miny, _, _ = affine_crop(reference.shape, template.shape, transform)
+            reference_phase = reference_phase_at(
+                minx, miny, new_reference.shape[1], new_reference.shape[0])
+
+        keypoints_reference, keypoints_template = find_control_point_pairs(
+            reference_pyramid[level],
+            template_pyramid[level],
+            level_points,
+            level_search_region_size,
+            control_point_region_size,
+            scale_factor,
+            workers=workers,
+            reference_phase=reference_phase,
+            reference_xys=reference_xys,
+            cancel_token=cancel_token
+        )
+
+        if (len(np.squeeze(keypoints_reference)) == 0
+            or len(np.squeeze(keypoints_template)) == 0
+        ):
+            result["level_timings"].append(time.perf_counter() - level_start)
+
+            if level == 0:
+                return result
+            continue
+
+        kp_temp_norm = keypoints_template * level_scale / template_size - 0.5
+
+        fitness, point_count, xoptimal, yoptimal = fit_bilinear(
+            kp_temp_norm[:, 0],
+            kp_temp_norm[:, 1],
+            keypoints_reference[:, 0],
+            keypoints_reference[:, 1],
+            threshold = 1 / 5,
+            iteration_count = 20
+        )
+
+        result["level_timings"].append(time.perf_counter() - level_start)
+
+        if level > 0:
+            if fitness != -1:
+                coefficients = (xoptimal * level_scale, yoptimal * level_scale)
+            continue
 
-    result["fitness"] = fitness
-    result["point_count"] = point_count
-    result["xoptimal"] = xoptimal
-    result["yoptimal"] = yoptimal
+        result["keypoints_reference"] = keypoints_reference
+        result["keypoints_template"] = keypoints_template
+
+        result["fitness"] = fitness
+        result["point_count"] = point_count
+        result["xoptimal"] = xoptimal
+        result["yoptimal"] = yoptimal
 
     return result
 
 
+def inverse_bilinear_map(coeffx, coeffy, width, height, rect = None):
+    """
+    Computes the inverse of the bilinear maps defined by coeffx and coeffy,
+    i.e. for every pixel of the deformed image the location in the source
+    image it should be sampled from.
+
+    The bilinear maps take normalized source coordinates to pixel
+    coordinates, inverting them comes down to solving a quadratic equation
+    per pixel, which is done in closed form.
+
+    Parameters
+    ----------
+    coeffx : (scalar)[]
+             The parameters for the bilinear map for the x coordinates
+    coeffy : (scalar)[]
+             The parameters for the bilinear map for the y coordinates
+    width, height : int
+                    The size of the source and deformed image
+    rect : (int, int, int, int) or None
+           The x, y, width and height of the region of the deformed image to
+           compute the map for, defaults to the whole image
+
+    Returns
+    -------
+    map_x, map_y : (H, W) array_like
+                   The source x and y coordinates of every pixel in `rect`,
+                   pixels without a valid source location are mapped to -1
+    """
+    a, b, c, d = coeffx
+    e, f, g, h = coeffy
+
+    rx, ry, rw, rh = rect if rect is not None else (0, 0, width, height)
+
+    u, v = np.meshgrid(
+        np.arange(rx, rx + rw, dtype=np.float64) - a,
+        np.arange(ry, ry + rh, dtype=np.float64) - e,
+        sparse=True)
+
+    # Eliminating the normalized x coordinate s from
+    #   u = b * s + c * t + d * s * t
+    #   v = f * s + g * t + h * s * t
+    # leaves qa * t^2 + qb * t + qc = 0 for the normalized y coordinate t
+    qa = h * c - g * d
+    qb = d * v - g * b + f * c - h * u
+    qc = b * v - f * u
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Numerically stable root that reduces to -qc / qb when qa == 0
+        q = -0.5 * (qb + np.copysign(
+            np.sqrt(np.maximum(qb * qb - 4 * qa * qc, 0)), qb))
+        t = qc / q
+
+        sx = b + d * t
+        sy = f + h * t
+        s = np.where(
+            np.abs(sx) >= np.abs(sy),
+            (u - c * t) / sx,
+            (v - g * t) / sy)
+
+    map_x = (s + 0.5) * width
+    map_y = (t + 0.5) * height
+
+    invalid = ~(np.isfinite(map_x) & np.isfinite(map_y))
+    map_x[invalid] = -1
+    map_y[invalid] = -1
+
+    return (
+        map_x.astype(dtype=np.float32, subok=True, copy=False),
+        map_y.astype(dtype=np.float32, subok=True, copy=False)
+    )
+
+
 # @timeit
-def deformImage(image, coeffx, coeffy):
+def deformImage(image, coeffx, coeffy, tile_size = None, out = None, progress = None):
     """
     Deforms the image by using bilinear maps defined by the coeffx and coeffy.
 
+    The output is processed in square tiles. For every tile the inverse
+    sampling map is computed, only the region of the source image it refers
+    to is read and all channels are resampled in a single bilinear remap.
+    Peak memory is therefore bounded by the tile size instead of the image
+    size, as long as `out` is preallocated (e.g. memory-mapped).
+
     Parameters
     ----------
     image : (N, M, {3, 4}) array_like
@@ -709,43 +1308,65 @@ def deformImage(image, coeffx, coeffy):
              The parameters for the bilinear map for the x coordinates
     coeffy : (scalar)[]
              The parameters for the bilinear map for the y coordinates
+    tile_size : int or None
+                Width and height of the tiles, the whole image is processed
+                at once if None
+    out : (N, M, 4) array_like or None
+          Preallocated float32 array to write the result into
+    progress : callable(int, int) or None
+               Called after every tile with the number of finished tiles and
+               the total number of tiles
 
     Returns
     -------
     result : (N, M, 4) array_like
-             The deformed image
+             The deformed image as float32, pixels that do not map onto the
+             source image are transparent
     """
-    image = image.astype(np.float32)
-
     width  = image.shape[1]
     height = image.shape[0]
 
-    if image.shape[2] == 3:
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
+    if out is None:
+        out = np.empty((height, width, 4), dtype=np.float32)
+
+    tile_width = width if tile_size is None else tile_size
+    tile_height = height if tile_size is None else tile_size
+
+    tiles = [
+        (x, y, min(tile_width, width - x), min(tile_height, height - y))
+        for y in range(0, height, tile_height)
+        for x in range(0, width, tile_width)
+    ]
 
-    result = np.zeros((height, width, 4))
+    for i, (x, y, w, h) in enumerate(tiles):
+        map_x, map_y = inverse_bilinear_map(
+            coeffx, coeffy, width, height, rect=(x, y, w, h))
 
-    grid_x, grid_y = np.meshgrid(
-        np.arange(width), np.arange(height))
+        # Bounding box of the source pixels that contribute to this tile
+        minx = int(np.floor(np.clip(map_x.min(), 0, width - 1)))
+        miny = int(np.floor(np.clip(map_y.min(), 0, height - 1)))
+        maxx = int(np.floor(np.clip(map_x.max(), 0, width - 1))) + 2
+        maxy = int(np.floor(np.clip(map_y.max(), 0, height - 1))) + 2
 
-    grid_x_norm = (grid_x / width - 0.5).flatten()
-    grid_y_norm = (grid_y / height - 0.5).flatten()
+        source = image[miny:maxy, minx:maxx].astype(
+            dtype=np.float32, subok=True, copy=False)
 
-    apr_x = bilinear_function(
-        np.hstack((grid_x_norm, grid_y_norm)), *(coeffx))
+        if source.shape[2] == 3:
+            source = cv2.cvtColor(source, cv2.COLOR_RGB2RGBA)
 
-    apr_y = bilinear_function(
-        np.hstack((grid_x_norm, grid_y_norm)), *(coeffy))
+        map_x -= minx
+        map_y -= miny
 
-    for j in range(result.shape[2]):
-        interpolated = interpolate.griddata(
-            np.vstack((apr_x.flatten(), apr_y.flatten())).T,
-            image[:,:,j].flatten(),
-            np.vstack((grid_x.flatten(), grid_y.flatten())).T
+        out[y:y+h, x:x+w] = cv2.remap(
+            source,
+            map_x,
+            map_y,
+            cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=(0, 0, 0, 0)
         )
 
-        interpolated = interpolated.reshape(result.shape[:2])
-        interpolated[np.isnan(interpolated)] = 0
-        result[:,:,j] = interpolated
-    
-    return result
+        if progress is not None:
+            progress(i + 1, len(tiles))
+
+    return out
@@ -1,6 +1,7 @@
 from PyQt5.QtCore import QObject, pyqtSignal
 
 import src.backend.layers as beLayers
+import src.backend.cache as beCache
 
 class Group(QObject):
 
@@ -14,8 +15,12 @@ class Group(QObject):
         self._reference: beLayers.Layer = None
         self._templates: list[beLayers.Layer] = []
 
+        self._reference_cache = beCache.ReferenceCache()
+        self._evaluation_cache = beCache.EvaluationCache()
+
         self._dirty = True
         self.referenceChanged.connect(self.setDirty)
+        self.referenceChanged.connect(self._reference_cache.clear)
         self.templateAdded.connect(self.setDirty)
     
 
@@ -32,6 +37,12 @@ class Group(QObject):
     def referenceLayer(self):
         return self._reference
 
+    def referenceCache(self):
+        return self._reference_cache
+
+    def evaluationCache(self):
+        return self._evaluation_cache
+
     def setReferenceLayer(self, layer):
         if (layer is None
             or not isinstance(layer, beLayers.Layer)
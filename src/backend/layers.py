@@ -1,4 +1,4 @@
-from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 
 import numpy as np
 import cv2
@@ -9,15 +9,63 @@ import queue
 import resource
 
 import src.backend.conover as conover
+import src.util.scratch as scratch
+import src.util.threads as threads
+from src.backend.pyramid import TilePyramid
+from src.util.shared import SharedArray
+
+class LayerStorage:
+    # The full-resolution buffers are regular arrays in memory
+    Memory = 0
+    # The full-resolution buffers live in memory-mapped scratch files
+    MemoryMapped = 1
+    # Memory-mapped for layers of at least Layer.MemoryMapThreshold pixels
+    Automatic = 2
+
+
+def _drawPolyline(image, points, radius, value):
+    # A brush stroke with round caps and joins, a single point is a circle
+    if len(points) == 1:
+        cv2.circle(image, points[0], radius, value, -1, cv2.LINE_8)
+    else:
+        cv2.polylines(
+            image,
+            [np.int32(points)],
+            False,
+            value,
+            2 * radius + 1,
+            cv2.LINE_8
+        )
+
 
 class Layer(QObject): # Inherit QObject to use signals
     pixelsChanged = pyqtSignal()
     maskChanged = pyqtSignal()
+    # The full-resolution x, y, width and height of the part of the mask that
+    # changed, emitted along with maskChanged
+    maskRegionChanged = pyqtSignal(int, int, int, int)
     interpolationChanged = pyqtSignal()
+    # Finished tiles, total tiles
+    interpolationProgress = pyqtSignal(int, int)
+
+    # Size of the tiles the deformation is processed in, bounds the memory
+    # used on top of the in- and output images
+    DeformTileSize = 1024
+
+    # Leading dimension of the downscaled pixels and mask at most
+    DownscaledSize = 1000
+
+    # Milliseconds between two maskChanged signals of a brush stroke, about
+    # the refresh rate of a display
+    MaskChangedInterval = 16
+
+    DefaultStorage = LayerStorage.Automatic
+    MemoryMapThreshold = 16_000_000
 
     def __init__(self):
         super().__init__()
         self._filepath = None
+        self._storage = Layer.DefaultStorage
 
         # RGB float32
         self._full_resolution = None
@@ -25,15 +73,23 @@ class Layer(QObject): # Inherit QObject to use signals
 
         # RGBA float32
         self._full_resolution_interpolated = None
+        # Whether the above is just the current pixels, as without coefficients
+        self._interpolated_is_pixels = False
+        # The pyramid may ask for the copy from a pool thread
+        self._interpolated_lock = threading.Lock()
 
         # RGBA float32
         self._changed_interpolation_coeff = False
 
-        # RGBA float32 - Alpha for threshold
+        # uint8 - 255 where the pixel is masked out, 0 elsewhere
         self._full_resolution_mask = None
         self._downscaled_mask = None
         self._downscale_factor = 1
+        # Whether the whole masked image is stale, otherwise only the regions
+        # in _dirty_rects are, as (x0, y0, x1, y1)
         self._changed_mask = True
+        self._dirty_rects = []
+        self._masked_lock = threading.Lock()
 
         self._downscaled_content = None
 
@@ -43,6 +99,137 @@ class Layer(QObject): # Inherit QObject to use signals
         self._thread = None
         self._stop_thread = True
 
+        # Points of the current brush stroke that are not drawn yet, None
+        # outside of a stroke, and the last point that was drawn
+        self._stroke = None
+        self._stroke_last = None
+        self._stroke_radius = 0
+        self._stroke_value = 0
+
+        # Runs while maskChanged may not be emitted again, the points added in
+        # that time are drawn once it times out
+        self._mask_timer = QTimer(self)
+        self._mask_timer.setSingleShot(True)
+        self._mask_timer.setInterval(Layer.MaskChangedInterval)
+        self._mask_timer.timeout.connect(self._flushStrokeDelayed)
+
+        # Incremented whenever the pixels or the mask change, allows caches of
+        # derived data to detect that they are stale
+        self._generation = 0
+        # Incremented only when the pixels change, for data that does not
+        # depend on the mask
+        self._pixel_generation = 0
+
+        # Reduced resolutions of the full-resolution buffers, for the canvas
+        # and the downscaled pixels. They all have the size of the layer, so
+        # counting levels never builds a buffer
+        self._pixel_pyramid = TilePyramid(
+            self.fullResolutionPixels, shape=self._shape)
+        self._interpolated_pyramid = TilePyramid(
+            self.fullResolutionInterpolated, shape=self._shape)
+
+        # Copies of the pixels and mask in shared memory for worker processes,
+        # name -> (generation, SharedArray)
+        self._shared = {}
+        self._shared_lock = threading.Lock()
+
+
+    def generation(self):
+        return self._generation
+
+    def pixelGeneration(self):
+        return self._pixel_generation
+
+
+    def pixelPyramid(self):
+        return self._pixel_pyramid
+
+    def interpolatedPyramid(self):
+        return self._interpolated_pyramid
+
+
+    def generatePyramid(self):
+        """
+        Builds the pyramid of the interpolated image in the background, which
+        is what the canvas draws
+        """
+        return threads.TaskScheduler.getInstance().submit(
+            threads.TaskPriority.Interactive,
+            self._interpolated_pyramid.generate
+        )
+
+
+    def storage(self):
+        return self._storage
+
+    def setStorage(self, storage):
+        """
+        Applies to the buffers that are created afterwards, so it should be
+        set before the image data
+        """
+        self._storage = storage
+
+
+    def _allocate(self, shape, dtype):
+        # Zero-filled full-resolution buffer of the layer's storage
+        memory_mapped = (self._storage == LayerStorage.MemoryMapped
+            or (self._storage == LayerStorage.Automatic
+                and shape[0] * shape[1] >= Layer.MemoryMapThreshold))
+        return scratch.allocate(shape, dtype, memory_mapped)
+
+
+    def sharedPixels(self):
+        """
+        The full resolution pixels as float32 in shared memory, see
+        `src.util.shared.SharedArray`. The array is acquired for the caller,
+        who releases it once the workers are done with it.
+        """
+        return self._acquireShared("pixels", self.fullResolutionPixels, np.float32)
+
+    def sharedMasked(self):
+        """
+        The full resolution masked pixels as float32 in shared memory, see
+        `sharedPixels`
+        """
+        return self._acquireShared("masked", self.fullResolutionMasked, np.float32)
+
+    def sharedMask(self):
+        """
+        The full resolution mask in shared memory, see `sharedPixels`
+        """
+        return self._acquireShared("mask", self.fullResolutionMask, None)
+
+
+    def releaseShared(self):
+        """
+        Drops the copies in shared memory, a copy that is still held by a job
+        is freed once that job releases it
+        """
+        with self._shared_lock:
+            for _, shared in self._shared.values():
+                shared.retire()
+            self._shared.clear()
+
+
+    def _acquireShared(self, name, array, dtype):
+        # The copy is made once per generation. The stale copy is retired,
+        # it stays valid for the jobs that still hold it
+        with self._shared_lock:
+            generation, shared = self._shared.get(name, (None, None))
+
+            if generation != self._generation:
+                if shared is not None:
+                    shared.retire()
+
+                shared = SharedArray(array(), dtype)
+                self._shared[name] = (self._generation, shared)
+
+            return shared.acquire()
+
+
+    def _shape(self):
+        return (self.height(), self.width())
+
 
     def width(self):
         if self._full_resolution is not None:
@@ -75,25 +262,33 @@ class Layer(QObject): # Inherit QObject to use signals
             self._full_resolution_interpolated = conover.deformImage(
                 self.fullResolutionInterpolated(),
                 self._interpolation_coeff[0],
-                self._interpolation_coeff[1]
-            ).astype(
-                dtype=np.float32, subok=True, copy=False
+                self._interpolation_coeff[1],
+                tile_size=Layer.DeformTileSize,
+                out=self._allocate((self.height(), self.width(), 4), np.float32),
+                progress=self.interpolationProgress.emit
             )
+            self._interpolated_is_pixels = False
         
+        self._interpolated_pyramid.invalidateAll()
         self.interpolationChanged.emit()
 
 
     def fullResolutionInterpolated(self):
-        if (self._interpolation_coeff[0] is None
-            or self._interpolation_coeff[1] is None
-            or self._full_resolution_interpolated is None
-        ):
-            self._full_resolution_interpolated = cv2.cvtColor(
-                self.fullResolutionPixels().astype(np.float32),
-                cv2.COLOR_RGB2RGBA
-            )
+        with self._interpolated_lock:
+            if ((self._interpolation_coeff[0] is None
+                or self._interpolation_coeff[1] is None
+                or self._full_resolution_interpolated is None)
+                and not self._interpolated_is_pixels
+            ):
+                self._full_resolution_interpolated = scratch.fill(
+                    self._allocate((self.height(), self.width(), 4), np.float32),
+                    lambda pixels: cv2.cvtColor(
+                        pixels.astype(np.float32), cv2.COLOR_RGB2RGBA),
+                    self.fullResolutionPixels()
+                )
+                self._interpolated_is_pixels = True
         
-        return self._full_resolution_interpolated
+            return self._full_resolution_interpolated
     
 
     def setFullResolutionInterpolated(self, pixels):
@@ -101,21 +296,65 @@ class Layer(QObject): # Inherit QObject to use signals
             return
         
         self._full_resolution_interpolated = pixels
+        self._interpolated_is_pixels = False
+        self._interpolated_pyramid.invalidateAll()
 
 
     def fullResolutionMasked(self):
         if self.fullResolutionPixels() is None or self.fullResolutionMask() is None:
             return None
         
-        if self._full_resolution_masked is None or self._changed_mask:
-            _, mask = cv2.threshold(self.fullResolutionMask()[:,:,3], 0, 1, cv2.THRESH_BINARY_INV)
-            mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2RGB).astype(
-                dtype=np.float16, subok=True, copy=False)
+        with self._masked_lock:
+            rects, self._dirty_rects = self._dirty_rects, []
+
+            if self._full_resolution_masked is None or self._changed_mask:
+                self._full_resolution_masked = scratch.fill(
+                    self._allocate(self.fullResolutionPixels().shape, np.float16),
+                    conover.apply_mask,
+                    self.fullResolutionPixels(),
+                    self.fullResolutionMask()
+                )
+                self._changed_mask = False
+            else:
+                # Only the regions touched by the brush since the last call
+                for x0, y0, x1, y1 in rects:
+                    self._full_resolution_masked[y0:y1, x0:x1] = conover.apply_mask(
+                        self.fullResolutionPixels()[y0:y1, x0:x1],
+                        self.fullResolutionMask()[y0:y1, x0:x1]
+                    )
+
+            return self._full_resolution_masked
+
+
+    def _strokeRect(self, points, radius):
+        # The bounds of a stroke as (x0, y0, x1, y1) within the layer, or None
+        xs = [ x for x, _ in points ]
+        ys = [ y for _, y in points ]
+
+        x0 = max(0, min(xs) - radius)
+        y0 = max(0, min(ys) - radius)
+        x1 = min(self.width(), max(xs) + radius + 1)
+        y1 = min(self.height(), max(ys) + radius + 1)
+
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return (x0, y0, x1, y1)
+
+    def _addDirtyRect(self, points, radius):
+        rect = self._strokeRect(points, radius)
+        if rect is None:
+            return
+
+        with self._masked_lock:
+            self._dirty_rects.append(rect)
 
-            self._full_resolution_masked = self.fullResolutionPixels() * mask
-            self._changed_mask = False
 
-        return self._full_resolution_masked
+    def _emitMaskChanged(self, points, radius):
+        rect = self._strokeRect(points, radius)
+        if rect is not None:
+            x0, y0, x1, y1 = rect
+            self.maskRegionChanged.emit(x0, y0, x1 - x0, y1 - y0)
+        self.maskChanged.emit()
     
 
     def fullResolutionPixels(self):
@@ -125,24 +364,35 @@ class Layer(QObject): # Inherit QObject to use signals
         if pixels is None or len(pixels.shape) < 2:
             return
         
-        if len(pixels.shape) == 2 or pixels.shape[2] == 1:
-            # Monochrome
-            pixels = cv2.cvtColor(pixels, cv2.COLOR_GRAY2RGB)
-        elif pixels.shape[2] == 4:
-            # RGBA
-            pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2RGB)
-        
-        if pixels.dtype == np.uint8:
-            pixels = (pixels / 255).astype(
-                dtype=np.float16, subok=True, copy=False)
-        elif pixels.dtype == np.uint16:
-            pixels = (pixels / 65535).astype(
-                dtype=np.float16, subok=True, copy=False)
-        else:
-            pixels = pixels.astype(
-                dtype=np.float16, subok=True, copy=False)
+        def convert(pixels):
+            if len(pixels.shape) == 2 or pixels.shape[2] == 1:
+                # Monochrome
+                pixels = cv2.cvtColor(pixels, cv2.COLOR_GRAY2RGB)
+            elif pixels.shape[2] == 4:
+                # RGBA
+                pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2RGB)
+
+            if pixels.dtype == np.uint8:
+                return pixels / 255
+            elif pixels.dtype == np.uint16:
+                return pixels / 65535
+            return pixels
+
+        # Converted in strips, a memory-mapped layer never holds a full-size
+        # temporary
+        self._full_resolution = scratch.fill(
+            self._allocate((pixels.shape[0], pixels.shape[1], 3), np.float16),
+            convert,
+            pixels
+        )
+        self._changed_mask = True
+        self._interpolated_is_pixels = False
+        self._downscaled_content = None
+        self._generation += 1
+        self._pixel_generation += 1
 
-        self._full_resolution = pixels
+        self._pixel_pyramid.invalidateAll()
+        self._interpolated_pyramid.invalidateAll()
 
         self.pixelsChanged.emit()
     
@@ -152,8 +402,13 @@ class Layer(QObject): # Inherit QObject to use signals
 
 
     def downscaledPixels(self):
-        if self._downscaled_content is None:
+        if self._downscale_factor == 1:
             return self.fullResolutionPixels()
+
+        # A level of the pixel pyramid, assembled once
+        if self._downscaled_content is None:
+            self._downscaled_content = self._pixel_pyramid.level(
+                self._pixel_pyramid.levelFitting(Layer.DownscaledSize))
         return self._downscaled_content
     
     def downscaledMask(self):
@@ -168,7 +423,10 @@ class Layer(QObject): # Inherit QObject to use signals
     def endThread(self):
         self._stop_thread = True
         if self._thread is not None:
+            # Wakes the thread up if it is waiting for work
+            self._mask_queue.put(None)
             self._thread.join()
+            self._thread = None
         while self._mask_queue.qsize() > 0:
             self._mask_queue.get()
 
@@ -177,74 +435,146 @@ class Layer(QObject): # Inherit QObject to use signals
         self.endThread()
 
         # Create the new mask
-        self._full_resolution_mask = np.zeros((height, width, 4), dtype=np.float32)
+        self._full_resolution_mask = self._allocate((height, width), np.uint8)
 
-        # Create a downscaled version
-        leading_dim = max(width, height)
-        self._downscale_factor = min(1, 1000 / leading_dim)
+        # The downscaled version matches a level of the pixel pyramid
+        level = self._pixel_pyramid.levelFitting(Layer.DownscaledSize)
+        self._downscale_factor = 1 / 2 ** level
+        self._downscaled_content = None
 
         if self._downscale_factor == 1:
             self._thread = None
+            self._downscaled_mask = None
         else:
             self._thread = threading.Thread(target=self._consumeMaskQueue)
             self._thread.daemon = True
             self._stop_thread = False
             self._thread.start()
 
-            dw = int(width * self._downscale_factor)
-            dh = int(height * self._downscale_factor)
-            self._downscaled_mask = np.zeros((dh, dw, 4), dtype=np.float32)
-            self._downscaled_content = cv2.resize(
-                cv2.cvtColor(
-                    self.fullResolutionPixels().astype(np.float32),
-                    cv2.COLOR_RGB2RGBA
-                ),
-                (dw, dh),
-                interpolation=cv2.INTER_CUBIC
-            )
+            self._downscaled_mask = np.zeros(
+                self._pixel_pyramid.levelShape(level), dtype=np.uint8)
 
         self._changed_mask = True
+        self._generation += 1
+        self.maskRegionChanged.emit(0, 0, width, height)
         self.maskChanged.emit()
     
 
-    def drawCircleToMask(self, cx, cy, radius, value):
+    def drawCircleToMask(self, cx, cy, radius, masked):
+        """
+        Masks out the pixels within the circle, or unmasks them if `masked`
+        is False
+        """
+        points = [ (int(cx), int(cy)) ]
+        self._drawPolylineToMask(points, int(radius), 255 if masked else 0)
+
+        self._generation += 1
+        self._emitMaskChanged(points, int(radius))
+
+
+    def beginMaskStroke(self, x, y, radius, masked):
+        """
+        Starts a brush stroke at the point, see `drawCircleToMask`.
+
+        The points of a stroke are connected by lines as thick as the brush,
+        and are drawn in batches such that maskChanged is emitted at most once
+        every MaskChangedInterval milliseconds.
+        """
+        self.endMaskStroke()
+
+        self._stroke = [ (int(x), int(y)) ]
+        self._stroke_last = None
+        self._stroke_radius = int(radius)
+        self._stroke_value = 255 if masked else 0
+        self._requestFlush()
+
+    def continueMaskStroke(self, x, y):
+        if self._stroke is None:
+            return
+
+        point = (int(x), int(y))
+        if point == (self._stroke[-1] if len(self._stroke) > 0 else self._stroke_last):
+            return
+
+        self._stroke.append(point)
+        self._requestFlush()
+
+    def endMaskStroke(self):
+        if self._stroke is None:
+            return
+
+        self._mask_timer.stop()
+        self._flushStroke()
+        self._stroke = None
+        self._stroke_last = None
+
+
+    def _requestFlush(self):
+        if self._mask_timer.isActive():
+            return
+
+        self._flushStroke()
+        self._mask_timer.start()
+
+    def _flushStrokeDelayed(self):
+        if self._stroke is None or len(self._stroke) == 0:
+            return
+
+        self._flushStroke()
+        self._mask_timer.start()
+
+    def _flushStroke(self):
+        if self._stroke is None or len(self._stroke) == 0:
+            return
+
+        # Continues from the last batch so that the stroke has no gaps
+        points = self._stroke
+        if self._stroke_last is not None:
+            points = [ self._stroke_last ] + points
+
+        self._drawPolylineToMask(points, self._stroke_radius, self._stroke_value)
+        self._stroke_last = self._stroke[-1]
+        self._stroke = []
+
+        self._generation += 1
+        self._emitMaskChanged(points, self._stroke_radius)
+
+
+    def _drawPolylineToMask(self, points, radius, value):
         if self._downscale_factor == 1:
-            cv2.circle(
-                self._full_resolution_mask,
-                (int(cx), int(cy)),
-                int(radius),
-                value, -1, -1, 0
-            )
-        else:
-            self._mask_queue.put((
-                (int(cx), int(cy)), int(radius), value
-            ))
+            _drawPolyline(self._full_resolution_mask, points, radius, value)
+            self._addDirtyRect(points, radius)
+            return
+
+        # The full resolution is drawn on the mask thread
+        self._mask_queue.put((points, radius, value))
 
-        cv2.circle(
+        _drawPolyline(
             self._downscaled_mask,
-            (
-                int(cx * self._downscale_factor),
-                int(cy * self._downscale_factor),
-            ),
+            [
+                (int(x * self._downscale_factor), int(y * self._downscale_factor))
+                for x, y in points
+            ],
             int(radius * self._downscale_factor),
-            value,
-            -1, -1, 0
+            value
         )
-
-        self._changed_mask = True
-        self.maskChanged.emit()
     
 
     def _consumeMaskQueue(self):
         while not self._stop_thread:
-            center, radius, value = self._mask_queue.get()
-            cv2.circle(
-                self._full_resolution_mask,
-                center,
-                radius,
-                value,
-                -1, -1, 0
-            )
+            # Everything queued since the last batch is drawn at once
+            batch = [ self._mask_queue.get() ]
+            while not self._mask_queue.empty():
+                batch.append(self._mask_queue.get())
+
+            for item in batch:
+                if item is None:
+                    return
+
+                points, radius, value = item
+                _drawPolyline(self._full_resolution_mask, points, radius, value)
+                # Only once drawn, an earlier refresh would miss the stroke
+                self._addDirtyRect(points, radius)
 
 
     def setImageData(self, file_path, pixels):
@@ -260,4 +590,6 @@ class Layer(QObject): # Inherit QObject to use signals
         self._full_resolution_masked = None
         self.fullResolutionMasked()
 
+        self.generatePyramid()
+
         print("{} MB".format((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) // 1e3))
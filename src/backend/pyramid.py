@@ -0,0 +1,205 @@
+import threading
+import math
+
+import numpy as np
+import cv2
+
+class TilePyramid:
+    """
+    A lazily built mip-pyramid of an image, stored in square tiles.
+
+    Level 0 is the source image itself, every next level halves its width
+    and height, down to the first level that fits in a single tile. A tile
+    is computed from the four tiles of the level below it when it is first
+    asked for, and kept until the pyramid is invalidated.
+
+    The source is a callable that returns the current full-resolution image,
+    so that the pyramid always follows the buffer of its owner. Its height
+    and width are cached until `invalidateAll`, from the optional `shape`
+    callable if computing the source is expensive, so that counting levels
+    does not touch the image.
+    """
+
+    TileSize = 256
+
+    def __init__(self, source, tile_size = None, shape = None):
+        self._source = source
+        self._shape_source = shape
+        self._tile_size = tile_size or TilePyramid.TileSize
+        self._shape = None
+
+        self._lock = threading.Lock()
+        self._tiles = {}
+        # Incremented by every invalidation, a tile that was computed while
+        # one happened may be stale and is not kept
+        self._version = 0
+
+
+    def tileSize(self):
+        return self._tile_size
+
+
+    def _sourceShape(self):
+        # The height and width of the source, (0, 0) without one
+        with self._lock:
+            shape = self._shape
+            version = self._version
+
+        if shape is None:
+            if self._shape_source is not None:
+                shape = tuple(self._shape_source())
+            else:
+                source = self._source()
+                shape = (0, 0) if source is None else source.shape[:2]
+
+            # Not kept if the source was replaced meanwhile
+            with self._lock:
+                if self._version == version:
+                    self._shape = shape
+
+        return shape
+
+
+    def levelCount(self):
+        height, width = self._sourceShape()
+        if height == 0 or width == 0:
+            return 0
+
+        leading_dim = max(height, width)
+        return 1 + max(0, math.ceil(math.log2(max(1, leading_dim / self._tile_size))))
+
+
+    def levelShape(self, level):
+        """
+        The height and width of the level
+        """
+        height, width = self._sourceShape()
+        return (
+            -(-height // 2 ** level),
+            -(-width // 2 ** level)
+        )
+
+
+    def levelForScale(self, scale):
+        """
+        The coarsest level that still has at least one pixel per screen pixel
+        when the full resolution is drawn at the scale
+        """
+        if scale <= 0:
+            return self.levelCount() - 1
+
+        level = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        return int(np.clip(level, 0, max(0, self.levelCount() - 1)))
+
+
+    def levelFitting(self, size):
+        """
+        The finest level whose width and height are at most `size`
+        """
+        for level in range(self.levelCount()):
+            if max(self.levelShape(level)) <= size:
+                return level
+        return max(0, self.levelCount() - 1)
+
+
+    def tile(self, level, tx, ty):
+        """
+        The tile in column tx and row ty of the level, tiles at the right and
+        bottom edges are smaller than the tile size
+        """
+        size = self._tile_size
+
+        if level == 0:
+            return self._source()[ty*size:(ty+1)*size, tx*size:(tx+1)*size]
+
+        key = (level, tx, ty)
+        with self._lock:
+            tile = self._tiles.get(key)
+            version = self._version
+        if tile is not None:
+            return tile
+
+        # The four tiles below cover twice the area
+        below_height, below_width = self.levelShape(level - 1)
+        rows = [
+            np.concatenate([
+                self.tile(level - 1, x, y)
+                for x in (2 * tx, 2 * tx + 1)
+                if x * size < below_width
+            ], axis=1)
+            for y in (2 * ty, 2 * ty + 1)
+            if y * size < below_height
+        ]
+        below = np.concatenate(rows, axis=0)
+
+        tile = cv2.resize(
+            below.astype(np.float32, copy=False),
+            (-(-below.shape[1] // 2), -(-below.shape[0] // 2)),
+            interpolation=cv2.INTER_AREA
+        ).astype(below.dtype, copy=False)
+
+        if len(below.shape) == 3 and len(tile.shape) == 2:
+            tile = tile[:,:,np.newaxis]
+
+        with self._lock:
+            if self._version == version:
+                self._tiles[key] = tile
+
+        return tile
+
+
+    def region(self, level, x, y, width, height):
+        """
+        The region of the level, in the coordinates of that level
+        """
+        level_height, level_width = self.levelShape(level)
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(level_width, x + width), min(level_height, y + height)
+
+        source = self._source()
+        out = np.empty(
+            (max(0, y1 - y0), max(0, x1 - x0), *source.shape[2:]),
+            dtype=source.dtype)
+
+        size = self._tile_size
+        for ty in range(y0 // size, -(-y1 // size)):
+            for tx in range(x0 // size, -(-x1 // size)):
+                tile = self.tile(level, tx, ty)
+
+                # The overlap of the tile and the region
+                ox0, oy0 = max(x0, tx * size), max(y0, ty * size)
+                ox1 = min(x1, tx * size + tile.shape[1])
+                oy1 = min(y1, ty * size + tile.shape[0])
+
+                out[oy0-y0:oy1-y0, ox0-x0:ox1-x0] = \
+                    tile[oy0-ty*size:oy1-ty*size, ox0-tx*size:ox1-tx*size]
+
+        return out
+
+
+    def level(self, level):
+        """
+        The whole level as one array
+        """
+        height, width = self.levelShape(level)
+        return self.region(level, 0, 0, width, height)
+
+
+    def generate(self, cancel_token = None):
+        """
+        Computes every tile that is not cached yet, from fine to coarse
+        """
+        for level in range(1, self.levelCount()):
+            height, width = self.levelShape(level)
+            for ty in range(-(-height // self._tile_size)):
+                for tx in range(-(-width // self._tile_size)):
+                    if cancel_token is not None:
+                        cancel_token.check()
+                    self.tile(level, tx, ty)
+
+
+    def invalidateAll(self):
+        with self._lock:
+            self._version += 1
+            self._tiles.clear()
+            self._shape = None
@@ -0,0 +1,446 @@
+import functools
+import threading
+import random
+import heapq
+
+import numpy as np
+import cv2
+
+import src.backend.conover as conover
+import src.backend.search as search
+import src.backend.cache as beCache
+import src.util.threads as threads
+
+# The registration of a template onto a reference without any Qt, it is used by
+# `src.backend.solver.Solver` for the layers of a group and by `register` for
+# plain arrays and image files.
+
+class ConoverParams:
+    Order = 0
+    WindowSize = 1
+    SearchRegionSize = 2
+    ControlPointRegionSize = 3
+    ScaleFactor = 4
+    PyramidLevels = 5
+
+
+class SolverStage:
+    ControlPoints = 0
+    Transform = 1
+    Search = 2
+
+
+DefaultParameters = {
+    ConoverParams.Order: 3,
+    ConoverParams.WindowSize: 10,
+    ConoverParams.SearchRegionSize: 20,
+    ConoverParams.ControlPointRegionSize: 10,
+    ConoverParams.ScaleFactor: 1,
+    # 1 disables the coarse-to-fine registration
+    ConoverParams.PyramidLevels: 1
+}
+
+
+def mutateParameters(params, exclude = []):
+    params = params.copy()
+
+    if ConoverParams.Order not in exclude:
+        params[ConoverParams.Order] = max(
+            3, params[ConoverParams.Order] + random.randint(-2, 2))
+
+    if ConoverParams.WindowSize not in exclude:
+        params[ConoverParams.WindowSize] = max(
+            5, params[ConoverParams.WindowSize] + random.randint(-4, 4))
+
+    if ConoverParams.SearchRegionSize not in exclude:
+        params[ConoverParams.SearchRegionSize] = max(
+            params[ConoverParams.WindowSize],
+            params[ConoverParams.SearchRegionSize] + random.randint(-4, 4))
+
+    if ConoverParams.ControlPointRegionSize not in exclude:
+        params[ConoverParams.ControlPointRegionSize] = max(
+            params[ConoverParams.WindowSize],
+            min(
+                params[ConoverParams.SearchRegionSize] - 1,
+                params[ConoverParams.ControlPointRegionSize] + random.randint(-4, 4)
+                )
+            )
+
+    if ConoverParams.ScaleFactor not in exclude:
+        params[ConoverParams.ScaleFactor] = 1
+
+    return params
+
+
+class Image:
+    """
+    An image with a mask, offers the part of the interface of
+    `src.backend.layers.Layer` that the registration uses.
+
+    The pixels are stored as RGB float16 in [0, 1] like those of a layer, the
+    mask is a single channel where non-zero values exclude the pixel from the
+    registration.
+    """
+
+    def __init__(self, pixels, mask = None, file_path = None):
+        self._file_path = file_path
+
+        if len(pixels.shape) == 2 or pixels.shape[2] == 1:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_GRAY2RGB)
+        elif pixels.shape[2] == 4:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2RGB)
+
+        if pixels.dtype == np.uint8:
+            pixels = pixels / 255
+        elif pixels.dtype == np.uint16:
+            pixels = pixels / 65535
+        self._pixels = pixels.astype(np.float16)
+
+        # uint8 with 255 where the pixel is excluded, as in a layer
+        self._mask = np.zeros(self._pixels.shape[:2], dtype=np.uint8)
+        if mask is not None:
+            self._mask[np.asarray(mask) != 0] = 255
+
+        self._masked = None
+
+
+    @staticmethod
+    def fromFile(file_path, mask_path = None):
+        """
+        Reads a PNG or TIFF file, the optional mask is any image whose
+        non-zero pixels are excluded
+        """
+        pixels = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+        if pixels is None:
+            raise FileNotFoundError("Cannot read image: {}".format(file_path))
+        if len(pixels.shape) == 3:
+            pixels = cv2.cvtColor(pixels,
+                cv2.COLOR_BGR2RGB if pixels.shape[2] == 3 else cv2.COLOR_BGRA2RGBA)
+
+        mask = None
+        if mask_path is not None:
+            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                raise FileNotFoundError("Cannot read mask: {}".format(mask_path))
+
+        return Image(pixels, mask, file_path)
+
+
+    def generation(self):
+        # The pixels never change
+        return 0
+
+    def pixelGeneration(self):
+        return 0
+
+    def filePath(self):
+        return self._file_path
+
+    def width(self):
+        return self._pixels.shape[1]
+
+    def height(self):
+        return self._pixels.shape[0]
+
+
+    def fullResolutionPixels(self):
+        return self._pixels
+
+    def fullResolutionMask(self):
+        return self._mask
+
+    def fullResolutionMasked(self):
+        if self._masked is None:
+            self._masked = conover.apply_mask(self._pixels, self._mask)
+        return self._masked
+
+
+def optimize(reference, template, parameters = {}, scheduler = None,
+    cancel_token = None, progress = None, reference_cache = None,
+    evaluation_cache = None, matching_workers = 1, evaluate_at = None):
+    """
+    Searches the parameters that register the template onto the reference.
+
+    The control-point detection is searched first, then the matching of the
+    control-points is searched by the scheduler.
+
+    Parameters
+    ----------
+    reference, template : Image or src.backend.layers.Layer
+    parameters : dict
+                 Initial ConoverParams, missing ones are taken from
+                 DefaultParameters
+    scheduler : search.SearchScheduler or None
+                Defaults to search.SuccessiveHalving
+    cancel_token : threads.CancellationToken or None
+    progress : callable(int, int, float) or None
+               Called with the SolverStage, the iteration within the stage
+               and the best fitness so far or -1
+    reference_cache : cache.ReferenceCache or None
+    evaluation_cache : cache.EvaluationCache or None
+                       Caches that outlive the call, fresh ones are used if
+                       None
+    matching_workers : int
+                       Amount of processes the matching of an evaluation is
+                       spread over
+    evaluate_at : callable(dict, threads.CancellationToken) or None
+                  Runs `conover.conover` with the given keyword arguments
+                  somewhere else, such as a worker process
+
+    Returns
+    -------
+    result : dict or None
+             The result of `conover.conover` for the best parameters and
+             those parameters under "parameters", None if the search was
+             cancelled or no control-points were found
+    """
+    parameters = DefaultParameters | parameters
+    scheduler = scheduler or search.SuccessiveHalving()
+    cancel_token = cancel_token or threads.CancellationToken()
+    reference_cache = reference_cache or beCache.ReferenceCache()
+    evaluation_cache = evaluation_cache or beCache.EvaluationCache()
+
+    def report(stage, iteration, fitness):
+        if progress is not None:
+            progress(stage, iteration, fitness)
+
+    store = []
+    minheap = []
+
+    # Evaluations are keyed on the versions of the images they depend on, so
+    # repeated candidates are free even across calls with the same cache
+    template_version = (template, template.generation())
+    reference_version = (reference, reference.generation())
+
+    @functools.lru_cache(maxsize=2)
+    def modulus(order):
+        return conover.compute_modulus(
+            template.fullResolutionMasked().sum(2), order)
+
+    for i in range(15):
+        if cancel_token.isCancelled() or cancel_token.isExpired():
+            return None
+        report(SolverStage.ControlPoints, i + 1, -1)
+
+        params = mutateParameters(
+            parameters if len(minheap) == 0 else store[minheap[0][-1]][1],
+            exclude=[
+                ConoverParams.SearchRegionSize,
+                ConoverParams.ControlPointRegionSize,
+                ConoverParams.ScaleFactor
+            ]
+        )
+
+        control_points = evaluation_cache.entry((
+            "control_points",
+            *template_version,
+            params[ConoverParams.Order],
+            params[ConoverParams.WindowSize]
+        ), lambda: conover.identify_control_points(
+            modulus(params[ConoverParams.Order]),
+            params[ConoverParams.WindowSize]
+        ))
+
+        if len(control_points) == 0:
+            continue
+
+        score = -len(control_points)
+
+        store.append((control_points, params))
+
+        heapq.heappush(minheap, (
+            score,
+            -len(control_points),
+            i,
+            len(store) - 1 # Save the store index
+        ))
+
+
+    if len(minheap) == 0:
+        return None
+
+
+    store_index = minheap[0][-1]
+    control_points, base_params = store[store_index]
+
+    report(SolverStage.Transform, 1, -1)
+
+    transform = evaluation_cache.entry((
+        "transform",
+        *template_version,
+        *reference_version
+    ), lambda: conover.approximate_transformation(
+        reference.fullResolutionPixels(),
+        template.fullResolutionPixels(),
+        255 - template.fullResolutionMask(),
+        reference_features=reference_cache.features(reference)
+    ))
+
+    if cancel_token.isCancelled() or cancel_token.isExpired():
+        return None
+
+    base_params[ConoverParams.ControlPointRegionSize] = int(max(6, min(10, min(template.width(), template.height()) * 0.15)))
+    base_params[ConoverParams.SearchRegionSize] = base_params[ConoverParams.ControlPointRegionSize] * 2
+
+    reference_pixels = reference_cache.pixels(reference)
+    template_pixels = template.fullResolutionMasked().astype(np.float32)
+    template_mask = template.fullResolutionMask()
+
+    def propose(params):
+        return mutateParameters(params, exclude=[
+            ConoverParams.Order,
+            ConoverParams.WindowSize
+        ])
+
+    def conover_at(params, fidelity):
+        # A lower fidelity matches an evenly spread subset of the
+        # control-points
+        arguments = {
+            "order": params[ConoverParams.Order],
+            "windowsize": params[ConoverParams.WindowSize],
+            "search_region_size": params[ConoverParams.SearchRegionSize],
+            "control_point_region_size": params[ConoverParams.ControlPointRegionSize],
+            "scale_factor": params[ConoverParams.ScaleFactor],
+            "control_points": control_points[::max(1, round(1 / fidelity))],
+            "transform": transform,
+            "pyramid_levels": params[ConoverParams.PyramidLevels]
+        }
+
+        if evaluate_at is not None:
+            return evaluate_at(arguments, cancel_token)
+
+        result = conover.conover(
+            reference_pixels,
+            template_pixels,
+            mask=template_mask,
+            workers=matching_workers,
+            reference_phase_at=lambda *rect: reference_cache.phaseImage(reference, *rect),
+            cancel_token=cancel_token,
+            **arguments
+        )
+
+        # The aligned template is the same for all candidates, it is
+        # recreated for the best one instead of being cached for each
+        if result is not None:
+            result = result | { "aligned_template": None }
+        return result
+
+    progress_lock = threading.Lock()
+    evaluations = 0
+    best_so_far = None
+
+    def evaluate(params, fidelity):
+        nonlocal evaluations, best_so_far
+
+        result = evaluation_cache.entry((
+            "conover",
+            *template_version,
+            *reference_version,
+            tuple(sorted(params.items())),
+            fidelity
+        ), lambda: conover_at(params, fidelity))
+
+        with progress_lock:
+            evaluations += 1
+            if search.resultKey(result) < search.resultKey(best_so_far):
+                best_so_far = result
+
+            iteration = evaluations
+            fitness = -1 if best_so_far is None else best_so_far["fitness"]
+
+        report(SolverStage.Search, iteration, fitness)
+        return result
+
+    # A search that runs out of time returns the best result it found
+    best_params, best_result = scheduler.search(
+        base_params, propose, evaluate)
+
+    if cancel_token.isCancelled():
+        return None
+
+    if best_result is None:
+        best_result = {
+            "fitness": -1,
+            "point_count": 0
+        }
+    elif best_result["transform"] is not None:
+        _, aligned_template = conover.transform_template_affine(
+            reference_pixels, template_pixels, best_result["transform"])
+        best_result = best_result | { "aligned_template": aligned_template }
+
+    return {
+        "parameters": best_params,
+        **best_result
+    }
+
+
+def register(reference, template, reference_mask = None, template_mask = None,
+    deform = True, **kwargs):
+    """
+    Registers a template onto a reference without a GUI.
+
+    Parameters
+    ----------
+    reference, template : array_like or str
+                          Images as arrays, or paths of PNG or TIFF files
+    reference_mask, template_mask : array_like or str or None
+                                    Non-zero pixels are excluded
+    deform : bool
+             Whether to compute the deformed template
+    **kwargs
+        Passed on to `optimize`
+
+    Returns
+    -------
+    result : dict or None
+             The result of `optimize` with in addition:
+               - "offset", the position of the template in the reference
+               - "deformed", the deformed template as RGBA float32 or None
+             None if the registration was cancelled or failed to start
+    """
+    reference = _image(reference, reference_mask)
+    template = _image(template, template_mask)
+
+    result = optimize(reference, template, **kwargs)
+
+    if result is None:
+        return None
+
+    result["offset"] = (0, 0)
+    result["deformed"] = None
+
+    if result["fitness"] == -1:
+        return result
+
+    result["offset"] = (
+        float(result["transform"][0, 2]),
+        float(result["transform"][1, 2])
+    )
+
+    if deform:
+        # The same image the GUI shows for an aligned template
+        result["deformed"] = conover.deformImage(
+            cv2.cvtColor(
+                template.fullResolutionPixels().astype(np.float32),
+                cv2.COLOR_RGB2RGBA
+            ),
+            result["xoptimal"],
+            result["yoptimal"]
+        )
+
+    return result
+
+
+def _image(image, mask):
+    if isinstance(image, Image):
+        return image
+
+    if isinstance(image, str):
+        if mask is not None and not isinstance(mask, str):
+            loaded = Image.fromFile(image)
+            return Image(loaded.fullResolutionPixels(), mask, image)
+        return Image.fromFile(image, mask)
+
+    if isinstance(mask, str):
+        mask = cv2.imread(mask, cv2.IMREAD_GRAYSCALE)
+    return Image(np.asarray(image), mask)
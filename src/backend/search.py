@@ -0,0 +1,243 @@
+from concurrent import futures
+
+import collections
+import math
+import time
+
+import src.util.threads as threads
+
+def resultKey(result):
+    """
+    Sort key of a conover result, smaller is better.
+
+    A result without a valid fitness is worse than any valid one, equal
+    fitnesses are decided by the amount of points that fit.
+    """
+    if result is None or result["fitness"] == -1:
+        return (1, 0, 0)
+    return (0, result["fitness"], -result["point_count"])
+
+
+class SearchScheduler:
+    """
+    Decides which parameter candidates of a template are evaluated, and at
+    which fidelity.
+
+    `search` is called with two callables:
+      - `propose(params)` returns a mutation of the given parameters
+      - `evaluate(params, fidelity)` runs the registration with the given
+        parameters on the fraction `fidelity` of the control-points and
+        returns the result dict of `conover`
+
+    The search stops when the wall-clock budget in seconds or the budget of
+    evaluations runs out, where an evaluation at fidelity 0.5 counts as half
+    an evaluation, or when a full evaluation reaches `target_fitness`. An
+    evaluation that raises `threads.Cancelled` stops the search as well, the
+    best result found before it is returned.
+
+    A scheduler does not keep state between searches, so one instance can
+    serve several templates at once.
+    """
+
+    def __init__(self, time_budget = None, evaluation_budget = 15, target_fitness = 1 / 6):
+        self._time_budget = time_budget
+        self._evaluation_budget = evaluation_budget
+        self._target_fitness = target_fitness
+
+
+    def timeBudget(self):
+        return self._time_budget
+
+    def setTimeBudget(self, time_budget):
+        self._time_budget = time_budget
+
+
+    def evaluationBudget(self):
+        return self._evaluation_budget
+
+    def setEvaluationBudget(self, evaluation_budget):
+        self._evaluation_budget = evaluation_budget
+
+
+    def targetFitness(self):
+        return self._target_fitness
+
+    def setTargetFitness(self, target_fitness):
+        self._target_fitness = target_fitness
+
+
+    def search(self, params, propose, evaluate):
+        """
+        Returns the best parameters and the result of their highest fidelity
+        evaluation, the result is None if no candidate could be evaluated.
+        """
+        raise NotImplementedError
+
+
+    def concurrency(self):
+        """
+        The amount of evaluations `search` runs at once
+        """
+        return 1
+
+
+    def _deadline(self):
+        if self._time_budget is None:
+            return math.inf
+        return time.monotonic() + self._time_budget
+
+
+    def _reachedTarget(self, result):
+        return (result is not None
+            and result["fitness"] != -1
+            and result["fitness"] <= self._target_fitness)
+
+
+class HillClimbing(SearchScheduler):
+    """
+    Evaluates one mutation of the best parameters so far at a time, always at
+    full fidelity.
+    """
+
+    def search(self, params, propose, evaluate):
+        deadline = self._deadline()
+
+        best_params = params
+        best_result = None
+
+        spent = 0
+        while (spent + 1 <= self._evaluation_budget
+            and time.monotonic() < deadline
+            and not self._reachedTarget(best_result)
+        ):
+            spent += 1
+
+            candidate = propose(best_params)
+            try:
+                result = evaluate(candidate, 1)
+            except threads.Cancelled:
+                break
+
+            # As long as nothing was registered, the latest candidate is
+            # mutated further
+            if (best_result is None
+                or best_result["fitness"] == -1
+                or resultKey(result) < resultKey(best_result)
+            ):
+                best_params = candidate
+                best_result = result
+
+        return best_params, best_result
+
+
+class SuccessiveHalving(SearchScheduler):
+    """
+    Evaluates a population of mutations on a small fraction of the
+    control-points, and repeatedly keeps the best `1 / reduction` of them
+    while multiplying the fraction by `reduction`, until the survivors are
+    evaluated on all control-points.
+
+    The candidates of a round are evaluated in parallel by `workers` threads,
+    by default as many as the cores of one alignment task of the
+    TaskScheduler.
+    """
+
+    def __init__(self, candidates = 16, reduction = 2, min_fidelity = 1 / 8, workers = None, **kwargs):
+        super().__init__(**kwargs)
+
+        self._candidates = candidates
+        self._reduction = reduction
+        self._min_fidelity = min_fidelity
+        self._workers = workers
+
+
+    def workers(self):
+        if self._workers is not None:
+            return self._workers
+
+        # The searches of all alignment workers together use every core once
+        return threads.TaskScheduler.getInstance().coresPerTask(
+            threads.TaskPriority.Alignment)
+
+    def setWorkers(self, workers):
+        self._workers = workers
+
+
+    def concurrency(self):
+        return self.workers()
+
+
+    def search(self, params, propose, evaluate):
+        deadline = self._deadline()
+
+        population = [ propose(params) for _ in range(self._candidates) ]
+        fidelity = self._min_fidelity
+
+        best_params = params
+        best_result = None
+
+        spent = 0
+        # A private executor, the search itself runs on the alignment workers
+        # of the task scheduler and waiting on jobs of those can deadlock
+        workers = self.workers()
+        with futures.ThreadPoolExecutor(workers) as executor:
+            while len(population) > 0:
+                fidelity = min(1, fidelity)
+
+                # Drop the worst candidates that do not fit in the budget
+                affordable = int((self._evaluation_budget - spent) / fidelity + 1e-9)
+                population = population[:affordable]
+
+                if len(population) == 0 or time.monotonic() >= deadline:
+                    break
+
+                # Candidates are submitted as workers free up, so that a
+                # search that ends early leaves no evaluations queued
+                queued = collections.deque(enumerate(population))
+                jobs = {}
+                results = [ None ] * len(population)
+                cancelled = False
+                while len(queued) > 0 or len(jobs) > 0:
+                    while len(queued) > 0 and len(jobs) < workers and not cancelled:
+                        i, candidate = queued.popleft()
+                        jobs[executor.submit(evaluate, candidate, fidelity)] = i
+
+                    if len(jobs) == 0:
+                        break
+
+                    done, _ = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+                    for job in done:
+                        i = jobs.pop(job)
+                        try:
+                            results[i] = job.result()
+                        except threads.Cancelled:
+                            cancelled = True
+                            continue
+
+                        # A full evaluation that reaches the target ends the
+                        # search
+                        if fidelity == 1 and self._reachedTarget(results[i]):
+                            return population[i], results[i]
+                spent += fidelity * len(population)
+
+                ranking = sorted(
+                    range(len(population)),
+                    key=lambda i: (resultKey(results[i]), i))
+
+                # The best of the highest fidelity so far is kept in case the
+                # budget runs out before the full evaluation, a cancelled
+                # round only replaces it with an evaluation that finished
+                if not cancelled or results[ranking[0]] is not None:
+                    best_params = population[ranking[0]]
+                    best_result = results[ranking[0]]
+
+                if cancelled or fidelity == 1:
+                    break
+
+                population = [
+                    population[i]
+                    for i in ranking[:max(1, len(population) // self._reduction)]
+                ]
+                fidelity *= self._reduction
+
+        return best_params, best_result
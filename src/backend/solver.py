@@ -1,35 +1,39 @@
-from concurrent import futures
 from PyQt5.QtCore import QObject, pyqtSignal
 
 from src.util.errors import ErrorCode
 import src.util.threads as threads
+import src.util.dispatch as dispatch
+import src.util.shared as shared
 
 import src.backend.groups as beGroups
-import src.backend.conover as conover
+import src.backend.search as search
+import src.backend.workers as workers
+import src.backend.registration as registration
+from src.backend.registration import ConoverParams, SolverStage
 
-import random
-import heapq
+import functools
 
-import numpy as np
-
-class ConoverParams:
-    Order = 0
-    WindowSize = 1
-    SearchRegionSize = 2
-    ControlPointRegionSize = 3
-    ScaleFactor = 4
+class SolverBackend:
+    # Evaluations run on threads, control-point matching is spread over
+    # Solver.MatchingWorkers processes
+    Threads = 0
+    # Evaluations run on the process pool, on layers in shared memory
+    Processes = 1
 
 
 class Solver(QObject):
-    DefaultParameters = {
-        ConoverParams.Order: 3,
-        ConoverParams.WindowSize: 10,
-        ConoverParams.SearchRegionSize: 20,
-        ConoverParams.ControlPointRegionSize: 10,
-        ConoverParams.ScaleFactor: 1
-    }
+    DefaultParameters = registration.DefaultParameters
+
+    # Amount of processes the control-point matching of a single evaluation
+    # is spread over, None divides the cores of an alignment task over the
+    # evaluations the search runs at once
+    MatchingWorkers = None
 
-    finishedLayer = pyqtSignal(int)
+    # The template layer, emitted on the main thread once its result is in
+    finishedLayer = pyqtSignal(object)
+    # The template layer, its SolverStage, the iteration within the stage and
+    # the best fitness so far or -1
+    progressed = pyqtSignal(object, int, int, float)
 
 
     def __init__(self):
@@ -37,14 +41,22 @@ class Solver(QObject):
 
         self._group = None
         self._inital_parameters = []
-
-        self._results = []
+        self._scheduler = search.SuccessiveHalving()
+        self._deadline = None
+        self._backend = SolverBackend.Threads
+        self._cancel_token = None
+
+        self._results = {}
+        # The reference of the running alignment and its unfinished templates
+        self._reference = None
+        self._remaining = 0
+
+        # Created here so that it lives on the main thread
+        self._dispatcher = dispatch.MainThreadDispatcher.getInstance()
     
 
-    def result(self, id):
-        if id < 0 or id >= len(self._results):
-            return None
-        return self._results[id]
+    def result(self, template):
+        return self._results.get(template)
 
 
     def group(self):
@@ -63,6 +75,42 @@ class Solver(QObject):
         return ErrorCode.Ok
     
 
+    def scheduler(self):
+        return self._scheduler
+
+    def setScheduler(self, scheduler):
+        self._scheduler = scheduler
+
+
+    def backend(self):
+        return self._backend
+
+    def setBackend(self, backend):
+        self._backend = backend
+
+
+    def deadline(self):
+        return self._deadline
+
+    def setDeadline(self, seconds):
+        """
+        Limits the time spent on every template, a template that runs out of
+        time finishes with the best result found so far. None disables it.
+        """
+        self._deadline = seconds
+
+
+    def cancel(self):
+        """
+        Stops all templates of the last start, they finish without a result
+        """
+        if self._cancel_token is not None:
+            self._cancel_token.cancel()
+
+    def isCancelled(self):
+        return self._cancel_token is not None and self._cancel_token.isCancelled()
+
+
     def setInitialParameters(self, parameters):
         if self.group() is not None and len(parameters) != len(self.group().templateLayers()):
             return
@@ -89,174 +137,108 @@ class Solver(QObject):
             print("[Warning] No template layers selected")
             return ErrorCode.Solver_NoTemplates
 
+        self._cancel_token = threads.CancellationToken()
+        self._results = {}
+        self._reference = self.group().referenceLayer()
+        self._remaining = len(self.group().templateLayers())
+
         for i, template in enumerate(self.group().templateLayers()):
-            job = threads.ThreadPool.getInstance().submit(
+            job = threads.TaskScheduler.getInstance().submit(
+                threads.TaskPriority.Alignment,
                 self._optimize,
                 template=template,
-                parameters=self._inital_parameters[i].copy()
+                parameters=self._inital_parameters[i].copy(),
+                cancel_token=self._cancel_token
             )
 
-            job.add_done_callback(self._emitResults)
+            self._dispatcher.watch(job, functools.partial(self._emitResult, template))
         
         return ErrorCode.Ok
         
     
-    def _emitResults(self, future):
+    def _emitResult(self, template, future):
+        # Runs on the main thread, the future is done so this does not block
         try:
-            result = future.result(5)
-            self._results.append(result)
-
-            self.finishedLayer.emit(len(self._results) - 1)
-        except futures.TimeoutError:
-            return
-    
-
-    def _optimize(self, template, parameters = {}):
-        parameters = Solver.DefaultParameters | parameters
-
-        store = []
-        minheap = []
-
-        for i in range(15):
-            params = Solver.mutateParameters(
-                parameters if len(minheap) == 0 else store[minheap[0][-1]][1],
-                exclude=[
-                    ConoverParams.SearchRegionSize,
-                    ConoverParams.ControlPointRegionSize,
-                    ConoverParams.ScaleFactor
-                ]
-            )
-
-            wavelet = conover.compute_modulus(
-                template.fullResolutionMasked().sum(2),
-                params[ConoverParams.Order]
-            )
-
-            control_points = conover.identify_control_points(
-                wavelet,
-                params[ConoverParams.WindowSize]
-            )
-
-            if len(control_points) == 0:
-                continue
+            result = future.result()
+        except Exception as e:
+            print("[Error] Aligning {} failed: {}".format(template.filePath(), e))
+            result = None
 
-            score = -len(control_points)
-            print(score)
+        self._results[template] = result
 
-            store.append((control_points, params))
-
-            heapq.heappush(minheap, (
-                score,
-                -len(control_points),
-                i,
-                len(store) - 1 # Save the store index
-            ))
+        # The reference is shared by all templates, its copy in shared memory
+        # is kept until the last one is done
+        self._remaining -= 1
+        if self._remaining == 0:
+            self._reference.releaseShared()
 
+        self.finishedLayer.emit(template)
+    
 
-        if len(minheap) == 0:
-            return None
-        
+    def _optimize(self, template, parameters = {}, cancel_token = None):
+        reference = self.group().referenceLayer()
 
-        store_index = minheap[0][-1]
-        control_points, base_params = store[store_index]
-        
-        print(len(control_points))
+        def evaluate_at(arguments, cancel_token):
+            # The worker reads the layers from shared memory, which is kept
+            # alive until the job is done. A running evaluation can only be
+            # abandoned rather than interrupted
+            arrays = [
+                reference.sharedPixels(),
+                template.sharedMasked(),
+                template.sharedMask()
+            ]
+
+            try:
+                job = threads.ProcessPool.getInstance().submit(
+                    workers.evaluateConover,
+                    *[ array.handle() for array in arrays ],
+                    **arguments
+                )
+            except Exception:
+                for array in arrays:
+                    array.release()
+                raise
 
-        reference = self.group().referenceLayer()
+            shared.releaseWhenDone(job, *arrays)
+            return threads.waitForResult(job, cancel_token)
 
-        transform = conover.approximate_transformation(
-            reference.fullResolutionPixels(),
-            template.fullResolutionPixels(),
-            255 - np.clip(template.fullResolutionMask()[:,:,3] * 255, 0, 255).astype(np.uint8)
-        )
-
-        n = 0
-        max_n = 15
-        best_result = {
-            "fitness": -1,
-            "point_count": 0
-        }
-        best_params = base_params
-
-        best_params[ConoverParams.ControlPointRegionSize] = int(max(6, min(10, min(template.width(), template.height()) * 0.15)))
-        best_params[ConoverParams.SearchRegionSize] = best_params[ConoverParams.ControlPointRegionSize] * 2
-
-        while (n < max_n
-            and (best_result["fitness"] == -1 or best_result["fitness"] > 1 / 6)
-        ):
-            n += 1
-            print("{}/{}".format(n, max_n))
-
-            params = Solver.mutateParameters(best_params, exclude=[
-                ConoverParams.Order,
-                ConoverParams.WindowSize
-            ])
-
-            result = conover.conover(
-                reference.fullResolutionPixels().astype(np.float32),
-                template.fullResolutionMasked().astype(np.float32),
-                mask=template.fullResolutionMask()[:,:,3],
-                order=params[ConoverParams.Order],
-                windowsize=params[ConoverParams.WindowSize],
-                search_region_size=params[ConoverParams.SearchRegionSize],
-                control_point_region_size=params[ConoverParams.ControlPointRegionSize],
-                scale_factor=params[ConoverParams.ScaleFactor],
-                control_points=control_points,
-                transform=transform
+        processes = self.backend() == SolverBackend.Processes
+        try:
+            result = registration.optimize(
+                reference,
+                template,
+                parameters,
+                scheduler=self.scheduler(),
+                # The deadline of a template starts when its job does
+                cancel_token=threads.CancellationToken(cancel_token, self.deadline()),
+                progress=lambda *args: self.progressed.emit(template, *args),
+                reference_cache=self.group().referenceCache(),
+                # Shared by all runs on the group, so repeated candidates are free
+                evaluation_cache=self.group().evaluationCache(),
+                matching_workers=self.matchingWorkers(),
+                evaluate_at=evaluate_at if processes else None
             )
+        finally:
+            # Only the process backend publishes the layers to shared memory
+            if processes:
+                template.releaseShared()
 
-            if (
-                best_result is None
-                or best_result["fitness"] == -1
-                or (
-                    result["fitness"] != -1
-                    and (
-                        result["fitness"] < best_result["fitness"]
-                        or (
-                            result["fitness"] == best_result["fitness"]
-                            and result["point_count"] > best_result["point_count"]
-                        )
-                    )
-                )
-            ):
-                best_result = result
-                best_params = params
+        if result is None:
+            return None
 
-        print(best_params)
         return {
             "template": template,
-            "parameters": best_params,
-            **best_result
+            **result
         }
     
 
-    @staticmethod
-    def mutateParameters(params, exclude = []):
-        params = params.copy()
-
-        if ConoverParams.Order not in exclude:
-            params[ConoverParams.Order] = max(
-                3, params[ConoverParams.Order] + random.randint(-2, 2))
-
-        if ConoverParams.WindowSize not in exclude:
-            params[ConoverParams.WindowSize] = max(
-                5, params[ConoverParams.WindowSize] + random.randint(-4, 4))
-
-        if ConoverParams.SearchRegionSize not in exclude:
-            params[ConoverParams.SearchRegionSize] = max(
-                params[ConoverParams.WindowSize],
-                params[ConoverParams.SearchRegionSize] + random.randint(-4, 4))
-
-        if ConoverParams.ControlPointRegionSize not in exclude:
-            params[ConoverParams.ControlPointRegionSize] = max(
-                params[ConoverParams.WindowSize],
-                min(
-                    params[ConoverParams.SearchRegionSize] - 1,
-                    params[ConoverParams.ControlPointRegionSize] + random.randint(-4, 4)
-                    )
-                )
+    def matchingWorkers(self):
+        if Solver.MatchingWorkers is not None:
+            return Solver.MatchingWorkers
 
-        if ConoverParams.ScaleFactor not in exclude:
-            params[ConoverParams.ScaleFactor] = 1
-        
-        return params
+        cores = threads.TaskScheduler.getInstance().coresPerTask(
+            threads.TaskPriority.Alignment)
+        return max(1, cores // self.scheduler().concurrency())
+    
+
+    mutateParameters = staticmethod(registration.mutateParameters)
@@ -0,0 +1,43 @@
+import functools
+
+import src.backend.conover as conover
+from src.util.shared import attachSharedArray
+
+# Runs in the worker processes of `threads.ProcessPool`, so nothing in here may
+# depend on Qt. The layers are read in place from the shared memory they were
+# published to, only small derived data is kept per process.
+
+@functools.lru_cache(maxsize=8)
+def _phaseImage(pixels_handle, x, y, width, height):
+    with attachSharedArray(pixels_handle) as pixels:
+        return conover.phase_image(pixels[y:y+height, x:x+width].sum(2))
+
+
+def evaluateConover(reference_pixels, template_masked, template_mask, **kwargs):
+    """
+    Runs `conover.conover` on the handles of `Layer.sharedPixels` of the
+    reference, and `Layer.sharedMasked` and `Layer.sharedMask` of the
+    template, the keyword arguments are passed on.
+
+    The aligned template is left out of the result, it is as large as the
+    template and the same for every set of parameters.
+    """
+    with attachSharedArray(reference_pixels) as reference, \
+        attachSharedArray(template_masked) as template, \
+        attachSharedArray(template_mask) as mask:
+
+        # Shared by every evaluation, so never written to
+        for array in (reference, template, mask):
+            array.flags.writeable = False
+
+        result = conover.conover(
+            reference,
+            template,
+            mask=mask,
+            reference_phase_at=lambda *rect: _phaseImage(reference_pixels, *rect),
+            **kwargs
+        )
+
+    if result is not None:
+        result = result | { "aligned_template": None }
+    return result
@@ -0,0 +1,198 @@
+from concurrent import futures
+
+import argparse
+import contextlib
+import multiprocessing
+import random
+import json
+import csv
+import sys
+import io
+import os
+
+import numpy as np
+import cv2
+
+import src.backend.registration as registration
+import src.backend.search as search
+import src.util.threads as threads
+
+# `ir-gui align`, registers the pairs of a manifest without a display. Nothing
+# in here may depend on Qt.
+
+ManifestColumns = ["reference", "template", "reference_mask", "template_mask", "output"]
+
+
+def readManifest(file_path):
+    """
+    Reads a CSV file with a header that names at least the "reference" and
+    "template" columns, and optionally "reference_mask", "template_mask" and
+    "output". Relative paths are relative to the manifest.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+
+    pairs = []
+    with open(file_path, newline="") as file:
+        for row in csv.DictReader(file, skipinitialspace=True):
+            if not row.get("reference") or not row.get("template"):
+                raise ValueError("Line {} lacks a reference or template".format(len(pairs) + 2))
+
+            pairs.append({
+                column: os.path.join(directory, row[column]) if row.get(column) else None
+                for column in ManifestColumns
+            })
+
+    return pairs
+
+
+def writeImage(file_path, pixels):
+    """
+    Writes RGBA float32 pixels in [0, 1] as a 16 bit PNG or TIFF
+    """
+    pixels = np.clip(np.nan_to_num(pixels) * 65535, 0, 65535).astype(np.uint16)
+    if not cv2.imwrite(file_path, cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGRA)):
+        raise OSError("Cannot write image: {}".format(file_path))
+
+
+def alignPair(pair, parameters = {}, deadline = None, threads_per_pair = 1, seed = None, verbose = False):
+    """
+    Registers one pair of the manifest and writes the deformed template to
+    its output, returns a summary that can be stored as JSON
+    """
+    if seed is not None:
+        random.seed(seed)
+
+    summary = {
+        "reference": pair["reference"],
+        "template": pair["template"],
+        "output": pair["output"],
+        "fitness": -1
+    }
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stderr if verbose else output):
+        result = registration.register(
+            pair["reference"],
+            pair["template"],
+            reference_mask=pair["reference_mask"],
+            template_mask=pair["template_mask"],
+            deform=pair["output"] is not None,
+            parameters=parameters,
+            scheduler=search.SuccessiveHalving(workers=threads_per_pair),
+            cancel_token=threads.CancellationToken(timeout=deadline)
+        )
+
+    if result is None or result["fitness"] == -1:
+        return summary
+
+    if pair["output"] is not None:
+        writeImage(pair["output"], result["deformed"])
+
+    summary.update({
+        "fitness": float(result["fitness"]),
+        "point_count": int(result["point_count"]),
+        "offset": list(result["offset"]),
+        "transform": np.asarray(result["transform"]).tolist(),
+        "xoptimal": np.asarray(result["xoptimal"]).tolist(),
+        "yoptimal": np.asarray(result["yoptimal"]).tolist(),
+        "parameters": {
+            name: result["parameters"][value]
+            for name, value in vars(registration.ConoverParams).items()
+            if not name.startswith("_")
+        }
+    })
+    return summary
+
+
+def align(argv):
+    parser = argparse.ArgumentParser(
+        prog="ir-gui align",
+        description="Registers every template of a manifest onto its reference.")
+    parser.add_argument("manifest",
+        help="CSV file with the columns reference, template and optionally "
+             "reference_mask, template_mask and output")
+    parser.add_argument("-o", "--output-dir",
+        help="Directory for the deformed templates of pairs without an output, "
+             "they are not written if omitted")
+    parser.add_argument("-r", "--report",
+        help="File to write the JSON report to instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="Amount of pairs aligned at once")
+    parser.add_argument("-d", "--deadline", type=float,
+        help="Seconds spent per pair at most")
+    parser.add_argument("--pyramid-levels", type=int,
+        default=registration.DefaultParameters[registration.ConoverParams.PyramidLevels])
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    try:
+        pairs = readManifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print("[Error] {}".format(e), file=sys.stderr)
+        return 2
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for pair in pairs:
+            if pair["output"] is None:
+                name = os.path.splitext(os.path.basename(pair["template"]))[0]
+                pair["output"] = os.path.join(args.output_dir, name + "_aligned.png")
+
+    jobs = max(1, min(args.jobs, len(pairs)))
+    options = {
+        "parameters": {
+            registration.ConoverParams.PyramidLevels: args.pyramid_levels
+        },
+        "deadline": args.deadline,
+        # The cores are split over the pairs that run at once
+        "threads_per_pair": max(1, (os.cpu_count() or 1) // jobs),
+        "seed": args.seed,
+        "verbose": args.verbose
+    }
+
+    summaries = [None] * len(pairs)
+    failed = 0
+
+    # Every pair runs in a process of its own, spawned like threads.ProcessPool
+    with futures.ProcessPoolExecutor(
+        jobs,
+        multiprocessing.get_context("spawn"),
+        threads._initializeProcess
+    ) as executor:
+        jobs = {
+            executor.submit(alignPair, pair, **options): i
+            for i, pair in enumerate(pairs)
+        }
+
+        for job in futures.as_completed(jobs):
+            i = jobs[job]
+            try:
+                summaries[i] = job.result()
+            except Exception as e:
+                summaries[i] = {
+                    "reference": pairs[i]["reference"],
+                    "template": pairs[i]["template"],
+                    "output": pairs[i]["output"],
+                    "fitness": -1,
+                    "error": str(e)
+                }
+
+            if summaries[i]["fitness"] == -1:
+                failed += 1
+
+            print("[{}/{}] {}: {}".format(
+                len(pairs) - sum(summary is None for summary in summaries),
+                len(pairs),
+                pairs[i]["template"],
+                summaries[i].get("error", "fitness {:.4f}".format(summaries[i]["fitness"]))
+            ), file=sys.stderr)
+
+    report = json.dumps(summaries, indent=2)
+    if args.report is not None:
+        with open(args.report, "w") as file:
+            file.write(report)
+    else:
+        print(report)
+
+    return 0 if failed == 0 else 1
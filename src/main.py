@@ -1,12 +1,19 @@
 import sys
 
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
+def main():
+    # `ir-gui align` runs without Qt, so that it works without a display
+    if sys.argv[1:2] == ["align"]:
+        import src.cli
+        sys.exit(src.cli.align(sys.argv[2:]))
 
-import src.ui.window
+    gui()
+
+
+def gui():
+    from PyQt5.QtWidgets import QApplication
+
+    import src.ui.window
 
-def main():
     app = QApplication(sys.argv)
 
     dark = False
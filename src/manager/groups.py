@@ -4,7 +4,6 @@ import src.backend.groups as beGroups
 import src.ui.sidebar.groups as sbGroups
 
 import src.backend.layers as beLayers
-import src.ui.sidebar.layers as sbLayers
 
 import src.manager.layers as mgLayers
 
@@ -19,6 +18,8 @@ class GroupManager(QObject):
             GroupManager.__instance = self
         
         self._items = {}
+        # Per position in the item tuples, group -> item key
+        self._keys = ({}, {})
         self._count = 0
     
 
@@ -55,11 +56,11 @@ class GroupManager(QObject):
         else:
             return None
         
-        for item_key in self._items:
-            if self._items[item_key][in_index] == group:
-                return self._items[item_key][out_index]
+        item_key = self._keys[in_index].get(group, None)
+        if item_key is None:
+            return None
         
-        return None
+        return self._items[item_key][out_index]
 
 
 
@@ -69,10 +70,8 @@ class GroupManager(QObject):
         sb_group = sbGroups.GroupItem()
 
         name_to_belayer = (lambda name:
-            mgLayers.LayerManager.getInstance().getLayer(
-                layer=sbLayers.LayerList.getInstance().layerByName(name),
-                out_type=beLayers.Layer
-            )
+            mgLayers.LayerManager.getInstance().getLayerByName(
+                name, out_type=beLayers.Layer)
         )
 
         sb_group.referenceChanged.connect(
@@ -83,6 +82,8 @@ class GroupManager(QObject):
             lambda name: be_group.removeTemplateLayer(name_to_belayer(name)))
 
         self._items[self._count] = (be_group, sb_group)
+        for keys, group in zip(self._keys, self._items[self._count]):
+            keys[group] = self._count
         sb_group.removed.connect(self._removeItem(self._count))
         self._count += 1
 
@@ -112,6 +113,8 @@ class GroupManager(QObject):
             sb_group = item[1]
 
             del self._items[index]
+            for keys, group in zip(self._keys, item):
+                keys.pop(group, None)
 
             sbGroups.GroupPane.getInstance().removeGroup(sb_group)
 
@@ -17,6 +17,8 @@ class LayerManager(QObject):
             LayerManager.__instance = self
         
         self._items = {}
+        # Per position in the item tuples, layer -> item key
+        self._keys = ({}, {}, {})
         self._count = 0
     
 
@@ -50,11 +52,16 @@ class LayerManager(QObject):
         else:
             return None
         
-        for item_key in self._items:
-            if self._items[item_key][in_index] == layer:
-                return self._items[item_key][out_index]
+        item_key = self._keys[in_index].get(layer, None)
+        if item_key is None:
+            return None
         
-        return None
+        return self._items[item_key][out_index]
+    
+
+    def getLayerByName(self, name, out_type):
+        return self.getLayer(
+            sbLayers.LayerList.getInstance().layerByName(name), out_type)
     
 
     def addItem(self, file_path: str, pixels, name = "", initial_offset = QPointF(0, 0)):
@@ -71,6 +78,8 @@ class LayerManager(QObject):
         cv_layer.setPosition(cv_layer.position() + initial_offset)
 
         self._items[self._count] = (be_layer, sb_layer, cv_layer)
+        for keys, layer in zip(self._keys, self._items[self._count]):
+            keys[layer] = self._count
         sb_layer.removed.connect(self._removeItem(self._count))
         self._count += 1
 
@@ -100,6 +109,8 @@ class LayerManager(QObject):
             cv_layer = item[2]
 
             del self._items[index]
+            for keys, layer in zip(self._keys, item):
+                keys.pop(layer, None)
 
             canvas.Canvas.getInstance().getView("main").removeItem(cv_layer)
             sbLayers.LayerList.getInstance().removeLayer(sb_layer)
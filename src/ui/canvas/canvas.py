@@ -21,8 +21,6 @@ class Canvas(QWidget):
             Canvas.__instance = self
         
         self._views: Dict[str, view.GraphicsView] = {}
-        self._translation = QPointF()
-        self._scale = 1
         
         self.initUI()
         self.addGraphicsView("main")
@@ -54,10 +52,13 @@ class Canvas(QWidget):
 
         EventHandler.getInstance().wheelEvent(qevent)
         factor = 1 + 0.2 * np.sign(EventHandler.getInstance().deltaWheel())
-        self._scale *= factor
 
         for name in self._views:
-            self._views[name].setScale(self._scale)
+            graphics_view = self._views[name]
+            graphics_view.setScale(
+                graphics_view.scale() * factor,
+                graphics_view.viewport().mapFrom(self, qevent.pos())
+            )
     
 
     def mousePressEvent(self, qevent: QMouseEvent):
@@ -73,12 +74,12 @@ class Canvas(QWidget):
         qevent.accept()
 
         EventHandler.getInstance().mouseMoveEvent(qevent)
-        factor = EventHandler.getInstance().deltaPos()
-        self._translation += factor
+        delta = EventHandler.getInstance().deltaPos()
 
         for name in self._views:
-            self._views[name].setTranslation(self._translation)
-            self._views[name].update()
+            if not delta.isNull():
+                self._views[name].setTranslation(
+                    self._views[name].translation() + delta)
             self._views[name].viewMouseMoveEvent(qevent)
 
 
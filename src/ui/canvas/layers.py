@@ -9,6 +9,7 @@ import src.backend.brush as beBrush
 import src.ui.toolbar.toolbar as toolbar
 
 import src.util.layers as uLayers
+from src.ui.canvas.tiles import PixmapTileCache
 
 import numpy as np
 import cv2
@@ -16,6 +17,20 @@ import cv2
 
 MaskColorRed = [0.95, 0.15, 0.30, 0.70]
 
+def visibleRect(painter: QPainter, exposed: QRectF):
+    """
+    The part of the exposed rectangle of an item that the painter can draw
+    on, in the coordinates of the item
+    """
+    # Not every painter reports a tight exposed rectangle, the part of the
+    # device it can draw on bounds it as well
+    inverse, invertible = painter.worldTransform().inverted()
+    if invertible:
+        exposed = exposed.intersected(
+            inverse.mapRect(QRectF(painter.viewport())))
+    return exposed
+
+
 class RenderMode:
     Pixels = 1
     Mask = 2
@@ -25,6 +40,9 @@ class RenderMode:
 class PixmapLayer(QGraphicsPixmapItem):
     __SelectionPen = None
 
+    # Leading dimension of the pyramid level the sidebar thumbnail is made of
+    ThumbnailSize = 256
+
 
     def __init__(self):
         super().__init__()
@@ -36,6 +54,8 @@ class PixmapLayer(QGraphicsPixmapItem):
             PixmapLayer.__SelectionPen = pen
         
         self.setTransformationMode(Qt.SmoothTransformation)
+        # Only the tiles in the exposed rectangle are drawn
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
 
         self._linked_sidebar_layer = None
         self._linked_backend_layer = None
@@ -43,12 +63,9 @@ class PixmapLayer(QGraphicsPixmapItem):
         self._view = None
 
         self._position = QPointF(0, 0)
-
-        # Transformations from view
-        self._translation = QPointF(0, 0)
-        self._scale = 1
-        self._scale_offset = QPointF(0, 0)
-        self._origin = QPointF(0.5, 0.5)
+        # The match items drawn relative to this layer, they are told when it
+        # moves, see `MatchesLayer.setLayers`
+        self._matches_layers = []
 
         self._selected = False
 
@@ -56,6 +73,16 @@ class PixmapLayer(QGraphicsPixmapItem):
 
         self._render_mode = RenderMode.Pixels
         self._composition_mode = QPainter.CompositionMode_SourceOver
+
+        # In RenderMode.Mask the overlay at display resolution, as a BGRX
+        # array and an image sharing its memory, patched where the mask
+        # changes instead of being rebuilt
+        self._mask_overlay = None
+        self._mask_image = None
+
+        # Outside of RenderMode.Mask the layer is drawn in tiles of the
+        # interpolated pyramid, so it has no pixmap of its own
+        self._thumbnail = QPixmap()
     
 
     def tifXResolution(self):
@@ -143,7 +170,7 @@ class PixmapLayer(QGraphicsPixmapItem):
         self._linked_sidebar_layer.opacityChanged.connect(self.setOpacity)
         self._linked_sidebar_layer.indexChanged.connect(self.__indexChangedSlot)
         self._linked_sidebar_layer.compositionModeChanged.connect(self.__compositionModeChangedSlot)
-        self._linked_sidebar_layer.setThumbnail(self.pixmap())
+        self._linked_sidebar_layer.setThumbnail(self._thumbnail)
     
 
     def unlinkBackendLayer(self):
@@ -151,7 +178,8 @@ class PixmapLayer(QGraphicsPixmapItem):
             return
         
         self.pixmap().fill(Qt.transparent)
-        self._linked_backend_layer.maskChanged.disconnect(self.__maskChangedSlot)
+        PixmapTileCache.getInstance().drop(self)
+        self._linked_backend_layer.maskRegionChanged.disconnect(self.__maskRegionChangedSlot)
         self._linked_backend_layer.pixelsChanged.disconnect(self.__pixelsChangedSlot)
         self._linked_backend_layer.interpolationChanged.disconnect(self.__interpolationChangedSlot)
         toolbar.ToolBar.getInstance().toolChanged.disconnect(self.__toolChangedSlot)
@@ -168,7 +196,7 @@ class PixmapLayer(QGraphicsPixmapItem):
         toolbar.ToolBar.getInstance().toolChanged.connect(self.__toolChangedSlot)
         self._linked_backend_layer.interpolationChanged.connect(self.__interpolationChangedSlot)
         self._linked_backend_layer.pixelsChanged.connect(self.__pixelsChangedSlot)
-        self._linked_backend_layer.maskChanged.connect(self.__maskChangedSlot)
+        self._linked_backend_layer.maskRegionChanged.connect(self.__maskRegionChangedSlot)
         self.updatePixmap()
     
 
@@ -184,29 +212,50 @@ class PixmapLayer(QGraphicsPixmapItem):
             self.pixmap().fill(Qt.transparent)
             return
         
-        array = None
-
-        if self.renderMode() == RenderMode.Interpolated:
-            array = self._linked_backend_layer.fullResolutionInterpolated()
+        self._mask_overlay = None
+        self._mask_image = None
+        PixmapTileCache.getInstance().drop(self)
 
-        elif self.renderMode() == RenderMode.Mask:
-            array = self._linked_backend_layer.downscaledPixels().astype(np.float32)
-            array = cv2.addWeighted(
-                cv2.cvtColor(array, cv2.COLOR_RGB2RGBA), 0.5,
-                self._linked_backend_layer.downscaledMask(), 0.5,
-                0.0
+        if self.renderMode() == RenderMode.Mask:
+            height, width = self._linked_backend_layer.downscaledMask().shape
+            self._mask_overlay = np.empty((height, width, 4), dtype=np.uint8)
+            self._mask_overlay[:,:,:] = self._maskOverlay(0, 0, width, height)
+            self._mask_image = QImage(
+                self._mask_overlay.data,
+                width,
+                height,
+                4 * width,
+                QImage.Format_RGB32
             )
-            array = cv2.cvtColor(array, cv2.COLOR_RGBA2RGB)
+            self.setPixmap(uLayers.numpyArrayToPixmap(
+                cv2.cvtColor(self._mask_overlay, cv2.COLOR_BGRA2RGB)))
+            self._thumbnail = self.pixmap()
 
         else:
-            array = self._linked_backend_layer.fullResolutionInterpolated()
+            self.prepareGeometryChange()
+            self.setPixmap(QPixmap())
 
-        self.setPixmap(
-            uLayers.numpyArrayToPixmap(array)
-        )
+            pyramid = self._linked_backend_layer.interpolatedPyramid()
+            self._thumbnail = uLayers.numpyArrayToPixmap(pyramid.level(
+                pyramid.levelFitting(PixmapLayer.ThumbnailSize)))
+            self.update()
 
         if self._linked_sidebar_layer is not None:
-            self._linked_sidebar_layer.setThumbnail(self.pixmap())
+            self._linked_sidebar_layer.setThumbnail(self._thumbnail)
+    
+
+    def _maskOverlay(self, x0, y0, x1, y1):
+        # The pixels of the region at display resolution, darkened and tinted
+        # with the brush colour where masked, as BGRX uint8
+        array = self._linked_backend_layer.downscaledPixels()[y0:y1, x0:x1, :3].astype(np.float32)
+        mask = self._linked_backend_layer.downscaledMask()[y0:y1, x0:x1] != 0
+        color = np.float32(beBrush.MaskBrush.getInstance().colorRed())
+
+        array *= 0.5
+        array[mask] += 0.5 * color[3] * color[:3]
+
+        return cv2.cvtColor(
+            (array * 255).astype(np.uint8), cv2.COLOR_RGB2BGRA)
     
 
     def opacity(self):
@@ -220,43 +269,85 @@ class PixmapLayer(QGraphicsPixmapItem):
         return self._position
     
     def setPosition(self, pos):
-        self._position = pos
-        self.setPos(self._position + self.translation() - self._scale_offset)
+        # Pan and zoom are the transform of the view's root item, the
+        # position is the offset within it
+        self._position = QPointF(pos)
+        self.setPos(self._position)
 
+        for matches in self._matches_layers:
+            matches.layerMoved()
 
-    def translation(self):
-        return self._translation
 
-    def setTranslation(self, point):
-        self._translation = QPointF(point)
-        self.setPosition(self.position())
-    
+    def addMatchesLayer(self, matches):
+        if matches not in self._matches_layers:
+            self._matches_layers.append(matches)
 
-    def scale(self):
-        return self._scale
+    def removeMatchesLayer(self, matches):
+        if matches in self._matches_layers:
+            self._matches_layers.remove(matches)
 
-    def setScale(self, scalar, origin = QPointF(0, 0)):
-        factor = scalar / self._scale
 
-        self._scale = scalar
-        super().setScale(scalar)
+    def _isTiled(self):
+        return (self._linked_backend_layer is not None
+            and self.renderMode() != RenderMode.Mask)
 
-        delta = (origin - self.pos()) * (factor - 1)
-        self._scale_offset += delta
-        self.setPosition(self.position())
+
+    def _paintTiles(self, painter: QPainter, exposed: QRectF):
+        pyramid = self._linked_backend_layer.interpolatedPyramid()
+        if pyramid.levelCount() == 0:
+            return
+
+        # The level with about one pixel per device pixel
+        level = pyramid.levelForScale(abs(painter.worldTransform().m11()))
+        height, width = pyramid.levelShape(level)
+        size = pyramid.tileSize()
+        extent = size * 2 ** level
+
+        exposed = visibleRect(painter, exposed).intersected(self.boundingRect())
+        tx0 = max(0, int(exposed.left() // extent))
+        ty0 = max(0, int(exposed.top() // extent))
+        tx1 = min(-(-width // size), int(np.ceil(exposed.right() / extent)))
+        ty1 = min(-(-height // size), int(np.ceil(exposed.bottom() / extent)))
+
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        cache = PixmapTileCache.getInstance()
+
+        for ty in range(ty0, ty1):
+            for tx in range(tx0, tx1):
+                tile = cache.tile(self, (level, tx, ty), lambda: uLayers.numpyArrayToPixmap(
+                    np.ascontiguousarray(pyramid.tile(level, tx, ty))))
+
+                painter.drawPixmap(
+                    QRectF(
+                        tx * extent,
+                        ty * extent,
+                        tile.width() * 2 ** level,
+                        tile.height() * 2 ** level
+                    ),
+                    tile,
+                    QRectF(tile.rect())
+                )
 
     
     def paint(self, painter: QPainter, option, widget = None):
         painter.save()
         painter.setCompositionMode(self._composition_mode)
 
-        if self.renderMode() == RenderMode.Mask:
+        if self._isTiled():
+            self._paintTiles(painter, option.exposedRect)
+
+        elif self._mask_image is not None:
             painter.scale(
                 1 / self._linked_backend_layer.downscaleFactor(),
                 1 / self._linked_backend_layer.downscaleFactor(),
             )
 
-        super().paint(painter, option, widget)
+            # Drawn from the patched overlay, the pixmap is only rebuilt by
+            # updatePixmap
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            painter.drawImage(self.offset(), self._mask_image)
+        else:
+            super().paint(painter, option, widget)
         painter.restore()
 
         if self.isLayerSelected():
@@ -274,7 +365,12 @@ class PixmapLayer(QGraphicsPixmapItem):
         super_rect = super().boundingRect()
         super_size = super_rect.size()
 
-        if self.renderMode() == RenderMode.Mask:
+        if self._isTiled():
+            super_size = QSizeF(
+                self._linked_backend_layer.width(),
+                self._linked_backend_layer.height())
+
+        elif self.renderMode() == RenderMode.Mask and self._linked_backend_layer is not None:
             super_size = super_size / self._linked_backend_layer.downscaleFactor()
 
         return QRectF(
@@ -297,7 +393,7 @@ class PixmapLayer(QGraphicsPixmapItem):
             sbLayers.LayerList.getInstance().changeSelection(
                 self._linked_sidebar_layer, qevent)
         else:
-            self.__tryPaintToMask(qevent)
+            self.__tryPaintToMask(qevent, begin=True)
 
 
     def mouseMoveEvent(self, qevent: QGraphicsSceneMouseEvent):
@@ -309,7 +405,7 @@ class PixmapLayer(QGraphicsPixmapItem):
             ):
                 return
             
-            delta = (qevent.pos() - qevent.lastPos()) * self.scale()
+            delta = qevent.pos() - qevent.lastPos()
             for layer in self.view()._items:
                 if not isinstance(layer, PixmapLayer):
                     continue
@@ -320,32 +416,45 @@ class PixmapLayer(QGraphicsPixmapItem):
             self.__tryPaintToMask(qevent)
 
     def mouseReleaseEvent(self, qevent: QGraphicsSceneMouseEvent):
-        pass
+        if self._linked_backend_layer is not None:
+            self._linked_backend_layer.endMaskStroke()
+
+        # The thumbnail follows the overlay once per stroke
+        if self._mask_image is not None and self._linked_sidebar_layer is not None:
+            self._thumbnail = QPixmap.fromImage(self._mask_image)
+            self._linked_sidebar_layer.setThumbnail(self._thumbnail)
     
 
-    def __tryPaintToMask(self, qevent):
+    def __tryPaintToMask(self, qevent, begin = False):
         if (toolbar.ToolBar.getInstance().activeTool() != toolbar.Tool.MaskBrush
             or not self._linked_sidebar_layer.isLayerSelected()
         ):
             return
         
-        color = None
+        masked = None
         if qevent.buttons() == Qt.LeftButton:
-            color = beBrush.MaskBrush.getInstance().colorRed()
+            masked = True
         elif qevent.buttons() == Qt.RightButton:
-            color = beBrush.MaskBrush.getInstance().colorNone()
+            masked = False
         
         radius = beBrush.MaskBrush.getInstance().radius()
-        if color is None or radius <= 0:
+        if masked is None or radius <= 0:
             return
 
 
-        self._linked_backend_layer.drawCircleToMask(
-            qevent.pos().x(),
-            qevent.pos().y(),
-            radius,
-            color
-        )
+        # Samples of a drag are merged into a single stroke
+        if begin:
+            self._linked_backend_layer.beginMaskStroke(
+                qevent.pos().x(),
+                qevent.pos().y(),
+                radius,
+                masked
+            )
+        else:
+            self._linked_backend_layer.continueMaskStroke(
+                qevent.pos().x(),
+                qevent.pos().y()
+            )
 
 
     def __indexChangedSlot(self, index):
@@ -359,9 +468,28 @@ class PixmapLayer(QGraphicsPixmapItem):
         if self.renderMode() == RenderMode.Pixels:
             self.updatePixmap()
 
-    def __maskChangedSlot(self):
-        if self.renderMode() == RenderMode.Mask:
+    def __maskRegionChangedSlot(self, x, y, width, height):
+        if self.renderMode() != RenderMode.Mask:
+            return
+
+        mask = self._linked_backend_layer.downscaledMask()
+        if self._mask_overlay is None or self._mask_overlay.shape[:2] != mask.shape:
             self.updatePixmap()
+            return
+
+        # The region at display resolution, grown by a pixel for rounding
+        factor = self._linked_backend_layer.downscaleFactor()
+        x0 = max(0, int(x * factor) - 1)
+        y0 = max(0, int(y * factor) - 1)
+        x1 = min(mask.shape[1], int(np.ceil((x + width) * factor)) + 1)
+        y1 = min(mask.shape[0], int(np.ceil((y + height) * factor)) + 1)
+
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        self._mask_overlay[y0:y1, x0:x1] = self._maskOverlay(x0, y0, x1, y1)
+        self.update(QRectF(
+            x0 / factor, y0 / factor, (x1 - x0) / factor, (y1 - y0) / factor))
     
     def __toolChangedSlot(self, tool):
         if self.isLayerSelected():
@@ -2,35 +2,56 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+import numpy as np
+
 import src.ui.sidebar.groups as sbGroups
 import src.ui.sidebar.layers as sbLayers
 import src.ui.canvas.layers as cvLayers
 
+import src.util.layers as uLayers
 import src.manager.layers as mgLayers
 
-class MatchesLayer(QGraphicsItemGroup):
-    
+class MatchesLayer(QGraphicsItem):
+    """
+    The keypoint matches between a template and its reference, kept as
+    arrays and drawn by this one item.
+
+    Every match is a line from its reference keypoint, marked with a circle,
+    to its template keypoint, marked with a square. Only the matches in the
+    exposed part of the view are drawn, all of them in a single call.
+    """
+
+    # Above this amount of visible matches only the lines are drawn
+    MarkerLimit = 5000
+    # Segments of the polygon that draws a keypoint circle
+    CircleSegments = 12
+
     def __init__(self):
         super().__init__()
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
 
         self._view = None
 
         self._position = QPointF(0, 0)
 
-        # Transformations from view
-        self._translation = QPointF(0, 0)
-        self._scale = 1
-        self._scale_offset = QPointF(0, 0)
-        self._origin = QPointF(0.5, 0.5)
-
         self._reference_layer = None
         self._sidebar_group = None
         self._sidebar_layer = None
 
+        # The canvas layers the keypoints are relative to
+        self._reference_canvas_layer = None
+        self._template_canvas_layer = None
+
         self._pen = QPen(QColor(255, 0, 0, 130))
         self._pen.setWidth(1)
+        self._keypoint_radius = 6
 
-        self._items: list[MatchGraphicsItem] = []
+        # (N, 2), the reference and template keypoint of every match
+        self._keypoints_reference = np.empty((0, 2), dtype=np.float64)
+        self._keypoints_template = np.empty((0, 2), dtype=np.float64)
+        # Their bounds relative to their layers
+        self._reference_bounds = QRectF()
+        self._template_bounds = QRectF()
     
 
     def pen(self):
@@ -38,18 +59,30 @@ class MatchesLayer(QGraphicsItemGroup):
 
     def setPen(self, pen):
         self._pen = pen
-        for item in self._items:
-            item.setPen(self.pen())
+        self.update()
+
+
+    def keyPointRadius(self):
+        return self._keypoint_radius
+    
+    def setKeyPointRadius(self, radius):
+        self.prepareGeometryChange()
+        self._keypoint_radius = radius
+
+
+    def matchCount(self):
+        return len(self._keypoints_reference)
 
 
     def remove(self):
-        for item in self.childItems():
-            self.removeFromGroup(item)
-        self._items.clear()
+        self.clearMatches()
+        self.setLayers(None, None)
         self.unlinkSideBarLayer()
         self.unlinkSideBarGroup()
         if self.view() is not None:
+            self.view().scaleChanged.disconnect(self._scaleChanged)
             self.view().removeItem(self)
+            self._view = None
     
 
     def setVisible(self, b):
@@ -108,187 +141,215 @@ class MatchesLayer(QGraphicsItemGroup):
         self._sidebar_layer = layer
         self._sidebar_layer.visibilityChanged.connect(self.setVisible)
 
-    
-    def addMatch(self, keypoint_reference: QPointF, keypoint_template: QPointF):
-        if self._sidebar_group is None or self._sidebar_layer is None:
-            return
 
-        item = MatchGraphicsItem()
-        item.setReferenceLayer(
-            mgLayers.LayerManager.getInstance().getLayer(
-                self._sidebar_group.referenceLayer(), cvLayers.PixmapLayer
-            )
-        )
-        item.setReferenceKeyPointPosition(keypoint_reference)
-        item.setTemplateLayer(
-            mgLayers.LayerManager.getInstance().getLayer(
-                self._sidebar_layer, cvLayers.PixmapLayer
-            )
-        )
-        item.setTemplateKeyPointPosition(keypoint_template)
-        item.setPen(self.pen())
+    def referenceLayer(self):
+        return self._reference_canvas_layer
 
-        self.addToGroup(item)
-        self._items.append(item)
+    def templateLayer(self):
+        return self._template_canvas_layer
+
+    def setLayers(self, reference, template):
+        """
+        The canvas layers of the reference and template keypoints, found
+        through the linked sidebar group and layer by `addMatches`
+        """
+        if (not isinstance(reference, cvLayers.PixmapLayer)
+            or not isinstance(template, cvLayers.PixmapLayer)
+        ):
+            reference, template = None, None
 
-        return item
-    
+        for layer in (self._reference_canvas_layer, self._template_canvas_layer):
+            if layer is not None:
+                layer.removeMatchesLayer(self)
 
-    def view(self):
-        return self._view
-    
-    def setView(self, view):
-        if view is None:
-            return
-        
-        if self.view() is not None:
-            self.view().removeItem(self)
+        self.prepareGeometryChange()
+        self._reference_canvas_layer = reference
+        self._template_canvas_layer = template
 
-        self._view = view
+        for layer in (reference, template):
+            if layer is not None:
+                layer.addMatchesLayer(self)
 
 
-    def position(self):
-        return self._position
+    def layerMoved(self):
+        # The keypoints move along with their layers
+        self.prepareGeometryChange()
+
     
-    def setPosition(self, pos):
-        self._position = pos
+    def addMatch(self, keypoint_reference: QPointF, keypoint_template: QPointF):
+        self.addMatches(
+            [[ keypoint_reference.x(), keypoint_reference.y() ]],
+            [[ keypoint_template.x(), keypoint_template.y() ]]
+        )
 
 
-    def translation(self):
-        return self._translation
+    def addMatches(self, keypoints_reference, keypoints_template):
+        """
+        Adds the matches of two (N, 2) arrays of keypoints, relative to the
+        reference and the template layer
+        """
+        if self._sidebar_group is not None and self._sidebar_layer is not None:
+            self.setLayers(
+                mgLayers.LayerManager.getInstance().getLayer(
+                    self._sidebar_group.referenceLayer(), cvLayers.PixmapLayer
+                ),
+                mgLayers.LayerManager.getInstance().getLayer(
+                    self._sidebar_layer, cvLayers.PixmapLayer
+                )
+            )
 
-    def setTranslation(self, point):
-        self._translation = QPointF(point)
-        self.setPosition(self.position())
-    
+        if self._reference_canvas_layer is None:
+            return
 
-    def scale(self):
-        return self._scale
+        keypoints_reference = np.asarray(keypoints_reference, dtype=np.float64).reshape(-1, 2)
+        keypoints_template = np.asarray(keypoints_template, dtype=np.float64).reshape(-1, 2)
+        if len(keypoints_reference) != len(keypoints_template):
+            print("[Warning] Unequal amount of reference and template keypoints")
+            return
 
-    def setScale(self, scalar, origin = QPointF(0, 0)):
-        factor = scalar / self._scale
+        self.prepareGeometryChange()
+        self._keypoints_reference = np.concatenate(
+            (self._keypoints_reference, keypoints_reference))
+        self._keypoints_template = np.concatenate(
+            (self._keypoints_template, keypoints_template))
+        self._reference_bounds = MatchesLayer._bounds(self._keypoints_reference)
+        self._template_bounds = MatchesLayer._bounds(self._keypoints_template)
 
-        self._scale = scalar
 
-        delta = (origin - self.pos()) * (factor - 1)
-        self._scale_offset += delta
-        self.setPosition(self.position())
+    def clearMatches(self):
+        self.prepareGeometryChange()
+        self._keypoints_reference = np.empty((0, 2), dtype=np.float64)
+        self._keypoints_template = np.empty((0, 2), dtype=np.float64)
+        self._reference_bounds = QRectF()
+        self._template_bounds = QRectF()
 
 
-    def mousePressEvent(self, qevent: QGraphicsSceneMouseEvent):
-        qevent.ignore()
+    @staticmethod
+    def _bounds(points):
+        if len(points) == 0:
+            return QRectF()
 
-    def mouseMoveEvent(self, qevent: QGraphicsSceneMouseEvent):
-        qevent.ignore()
+        x0, y0 = points.min(axis=0)
+        x1, y1 = points.max(axis=0)
+        return QRectF(x0, y0, x1 - x0, y1 - y0)
+
+
+    def _points(self):
+        # Both keypoints in the coordinates of this item, which shares its
+        # parent with the layers
+        return (
+            self._keypoints_reference + (
+                self._reference_canvas_layer.pos().x(),
+                self._reference_canvas_layer.pos().y()),
+            self._keypoints_template + (
+                self._template_canvas_layer.pos().x(),
+                self._template_canvas_layer.pos().y())
+        )
 
-    def mouseReleaseEvent(self, qevent: QGraphicsSceneMouseEvent):
-        qevent.ignore()
 
-    def __templateRemovedSlot(self, name):
-        if self._sidebar_layer.name() == name:
-            self.remove()
-    
+    def boundingRect(self):
+        if self._reference_canvas_layer is None or self.matchCount() == 0:
+            return QRectF()
 
-class MatchGraphicsItem(QGraphicsItem):
+        # The bounds of both sets of keypoints, moved along with their layers
+        reference = self._reference_bounds.translated(self._reference_canvas_layer.pos())
+        template = self._template_bounds.translated(self._template_canvas_layer.pos())
+        # Not united with |, which drops the empty bounds of a single keypoint
+        bounds = QRectF(
+            QPointF(min(reference.left(), template.left()),
+                min(reference.top(), template.top())),
+            QPointF(max(reference.right(), template.right()),
+                max(reference.bottom(), template.bottom())))
+
+        # The markers keep their size on screen
+        margin = self.keyPointRadius() + 1
+        if self.view() is not None:
+            margin /= self.view().scale()
 
-    def __init__(self):
-        super().__init__()
+        return bounds.adjusted(-margin, -margin, margin, margin)
 
-        self._reference_layer = None
-        self._template_layer = None
 
-        self._reference_position = QPointF()
-        self._template_position = QPointF()
+    def paint(self, painter: QPainter, option: QStyleOption, widget: QWidget = None):
+        if self._reference_canvas_layer is None or self.matchCount() == 0:
+            return
 
-        self._pen = QPen(QColor(255, 0, 0, 130))
-        self._pen.setWidth(1)
-        self._keypoint_radius = 6
-    
+        reference, template = self._points()
 
-    def boundingRect(self):
-        if self.referenceLayer() is None or self.templateLayer() is None:
-            return QRectF()
-        
-        return self.referenceLayer().boundingRect() | self.templateLayer().boundingRect()
-    
+        # The markers keep their size on screen at any zoom
+        radius = self.keyPointRadius() / max(1e-6, abs(painter.worldTransform().m11()))
 
-    def referenceKeyPointPosition(self):
-        return self._reference_position
-    
-    def setReferenceKeyPointPosition(self, point):
-        self._reference_position = point
-    
+        # Matches whose line or markers may reach the visible rectangle
+        visible = cvLayers.visibleRect(painter, option.exposedRect).adjusted(
+            -radius, -radius, radius, radius)
+        lower = np.minimum(reference, template)
+        upper = np.maximum(reference, template)
+        inside = ((upper[:,0] >= visible.left()) & (lower[:,0] <= visible.right())
+            & (upper[:,1] >= visible.top()) & (lower[:,1] <= visible.bottom()))
+        reference, template = reference[inside], template[inside]
 
-    def templateKeyPointPosition(self):
-        return self._template_position
-    
-    def setTemplateKeyPointPosition(self, point):
-        self._template_position = point
-    
+        if len(reference) == 0:
+            return
 
-    def referenceLayer(self):
-        return self._reference_layer
-    
-    def setReferenceLayer(self, layer):
-        if not isinstance(layer, cvLayers.PixmapLayer):
-            self._reference_layer = None
-        else:
-            self._reference_layer = layer
+        # Every segment as a pair of points, the lines first
+        segments = [ np.stack((reference, template), axis=1) ]
 
+        if len(reference) <= MatchesLayer.MarkerLimit:
+            angles = np.linspace(0, 2 * np.pi, MatchesLayer.CircleSegments + 1)
+            circle = radius * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+            square = radius * np.float64([[ -1, -1 ], [ 1, -1 ], [ 1, 1 ], [ -1, 1 ], [ -1, -1 ]])
 
-    def templateLayer(self):
-        return self._template_layer
+            for points, shape in ((reference, circle), (template, square)):
+                outline = points[:,np.newaxis,:] + shape[np.newaxis,:,:]
+                segments.append(np.stack(
+                    (outline[:,:-1], outline[:,1:]), axis=2).reshape(-1, 2, 2))
 
-    def setTemplateLayer(self, layer):
-        if not isinstance(layer, cvLayers.PixmapLayer):
-            self._template_layer = None
-        else:
-            self._template_layer = layer
-    
+        painter.save()
 
-    def keyPointRadius(self):
-        return self._keypoint_radius
-    
-    def setKeyPointRadius(self, radius):
-        self._keypoint_radius = radius
+        pen = QPen(self.pen())
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        painter.drawLines(uLayers.numpyArrayToPolygon(
+            np.concatenate(segments).reshape(-1, 2)))
+
+        painter.restore()
     
 
-    def pen(self):
-        return self._pen
+    def view(self):
+        return self._view
     
-    def setPen(self, pen):
-        self._pen = pen
+    def setView(self, view):
+        if view is None:
+            return
+        
+        if self.view() is not None:
+            self.view().scaleChanged.disconnect(self._scaleChanged)
+            self.view().removeItem(self)
 
+        self._view = view
+        self._view.scaleChanged.connect(self._scaleChanged)
 
-    def paint(self, painter: QPainter, option: QStyleOption, widget: QWidget = None):
-        if self.referenceLayer() is None or self.templateLayer() is None:
-            return
 
-        painter.save()
+    def _scaleChanged(self, scale):
+        # The margin of the markers depends on the zoom
+        self.prepareGeometryChange()
+
 
-        painter.setPen(self.pen())
+    def position(self):
+        return self._position
+    
+    def setPosition(self, pos):
+        self._position = pos
 
-        reference_center = (self.referenceLayer().scenePos()
-            + self.referenceKeyPointPosition() * self.referenceLayer().scale())
-        template_center = (self.templateLayer().scenePos()
-            + self.templateKeyPointPosition() * self.templateLayer().scale())
 
-        painter.drawLine(
-            reference_center,
-            template_center
-        )
+    def mousePressEvent(self, qevent: QGraphicsSceneMouseEvent):
+        qevent.ignore()
 
-        painter.drawEllipse(
-            reference_center,
-            self.keyPointRadius(),
-            self.keyPointRadius()
-        )
+    def mouseMoveEvent(self, qevent: QGraphicsSceneMouseEvent):
+        qevent.ignore()
 
-        painter.drawRect(
-            template_center.x() - self.keyPointRadius(),
-            template_center.y() - self.keyPointRadius(),
-            self.keyPointRadius() * 2,
-            self.keyPointRadius() * 2
-        )
+    def mouseReleaseEvent(self, qevent: QGraphicsSceneMouseEvent):
+        qevent.ignore()
 
-        painter.restore()
+    def __templateRemovedSlot(self, name):
+        if self._sidebar_layer.name() == name:
+            self.remove()
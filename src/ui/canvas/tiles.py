@@ -0,0 +1,77 @@
+from PyQt5.QtGui import QPixmap
+
+import collections
+
+class PixmapTileCache:
+    """
+    A least-recently-used cache of the QPixmap tiles of all canvas layers,
+    bounded by the memory of the pixmaps rather than by their amount.
+
+    Entries are keyed on their owner and a key within that owner, `drop`
+    removes everything of an owner once its content changes.
+    """
+    __instance = None
+
+    # 4 bytes per pixel, so about a thousand 256 x 256 tiles
+    MaxBytes = 256 * 1024 * 1024
+
+    def __init__(self):
+        if PixmapTileCache.__instance != None:
+            raise Exception("Singleton")
+        else:
+            PixmapTileCache.__instance = self
+
+        self._max_bytes = PixmapTileCache.MaxBytes
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+
+
+    def maxBytes(self):
+        return self._max_bytes
+
+    def setMaxBytes(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._evict()
+
+
+    def tile(self, owner, key, create):
+        """
+        The pixmap of the key, created with `create()` on a miss
+        """
+        entry = (owner, key)
+
+        pixmap = self._entries.get(entry)
+        if pixmap is not None:
+            self._entries.move_to_end(entry)
+            return pixmap
+
+        pixmap = create()
+        self._entries[entry] = pixmap
+        self._bytes += PixmapTileCache._size(pixmap)
+        self._evict()
+
+        return pixmap
+
+
+    def drop(self, owner):
+        for entry in [ entry for entry in self._entries if entry[0] is owner ]:
+            self._bytes -= PixmapTileCache._size(self._entries.pop(entry))
+
+
+    def _evict(self):
+        # The newest entry stays, even if it is larger than the budget
+        while self._bytes > self._max_bytes and len(self._entries) > 1:
+            _, pixmap = self._entries.popitem(last=False)
+            self._bytes -= PixmapTileCache._size(pixmap)
+
+
+    @staticmethod
+    def _size(pixmap: QPixmap):
+        return pixmap.width() * pixmap.height() * 4
+
+
+    @staticmethod
+    def getInstance():
+        if PixmapTileCache.__instance == None:
+            PixmapTileCache()
+        return PixmapTileCache.__instance
@@ -5,6 +5,9 @@ from PyQt5.QtWidgets import *
 import src.ui.canvas.layers as cvLayers
 
 class GraphicsView(QGraphicsView):
+
+    scaleChanged = pyqtSignal(float)
+
     def __init__(self):
         super().__init__()
 
@@ -13,11 +16,28 @@ class GraphicsView(QGraphicsView):
         self.setTransformationAnchor(QGraphicsView.NoAnchor)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        # Panning and zooming move everything on screen, so the whole viewport
+        # is redrawn either way
         self.setViewportUpdateMode(QGraphicsView.FullViewportUpdate)
         self.setScene(QGraphicsScene())
+        # Items only move relative to each other, an index would be rebuilt
+        # on every pan for nothing
+        self.scene().setItemIndexMethod(QGraphicsScene.NoIndex)
+        # A fixed scene rectangle at the origin, so that scene and viewport
+        # coordinates stay the same while items leave it
+        self.scene().setSceneRect(QRectF(0, 0, 1, 1))
 
         self.setProperty("elevation", "00dp")
 
+        # Every item is a child of this one, pan and zoom are its transform
+        # instead of being applied to each item
+        self._root = QGraphicsRectItem()
+        self._root.setFlag(QGraphicsItem.ItemHasNoContents)
+        self.scene().addItem(self._root)
+
+        self._translation = QPointF(0, 0)
+        self._scale = 1
+
         self._items: list[cvLayers.PixmapLayer] = []
     
 
@@ -25,7 +45,7 @@ class GraphicsView(QGraphicsView):
         if item not in self._items:
             item.setView(self)
             self._items.append(item)
-            self.scene().addItem(item)
+            item.setParentItem(self._root)
     
 
     def removeItem(self, item):
@@ -34,15 +54,38 @@ class GraphicsView(QGraphicsView):
             self.scene().removeItem(item)
     
 
+    def translation(self):
+        return self._translation
+
     def setTranslation(self, point):
-        for item in self._items:
-            item.setTranslation(point)
+        self._translation = QPointF(point)
+        self._updateTransform()
     
 
-    def setScale(self, scale):
-        cursor_pos = QCursor.pos() - self.viewport().mapToGlobal(QPoint(0, 0))
-        for item in self._items:
-            item.setScale(scale, cursor_pos)
+    def scale(self):
+        return self._scale
+
+    def setScale(self, scale, origin = None):
+        """
+        Zooms about the viewport point `origin`, the cursor by default
+        """
+        if origin is None:
+            origin = self.viewport().mapFromGlobal(QCursor.pos())
+        origin = self.mapToScene(QPoint(int(origin.x()), int(origin.y())))
+
+        # The point under the origin stays in place
+        self._translation = origin - (origin - self._translation) * (scale / self._scale)
+        self._scale = scale
+        self._updateTransform()
+        self.scaleChanged.emit(scale)
+
+
+    def _updateTransform(self):
+        self._root.setTransform(QTransform(
+            self._scale, 0,
+            0, self._scale,
+            self._translation.x(), self._translation.y()
+        ))
     
 
     def wheelEvent(self, qevent: QMouseEvent):
@@ -101,6 +101,7 @@ class GroupItem(QWidget):
     templateRemoved = pyqtSignal(str)
     removed = pyqtSignal()
     processStatusChanged = pyqtSignal(bool)
+    cancelRequested = pyqtSignal()
 
     showMatchesChanged = pyqtSignal(bool)
 
@@ -172,6 +173,17 @@ class GroupItem(QWidget):
             self._widgets["fitness"].setText("{:.4f}".format(value))
 
 
+    def setProgress(self, done, total):
+        if total <= 0:
+            return
+        self._widgets["fitness"].setText(
+            "Processing... {}%".format(int(100 * done / total)))
+
+
+    def setStatus(self, text):
+        self._widgets["fitness"].setText(text)
+
+
     def name(self):
         return self._name
 
@@ -303,6 +315,10 @@ class GroupItem(QWidget):
 
             layout.addWidget(spinner)
 
+            cancel = QPushButton("Cancel")
+            cancel.clicked.connect(lambda _: self.cancelRequested.emit())
+            layout.addWidget(cancel)
+
             return
 
         
@@ -138,6 +138,10 @@ class LayerList(QWidget):
 
         self._layer_names = {}
 
+        # Name -> layer and layer -> name, follows renames
+        self._layers_by_name = {}
+        self._names_by_layer = {}
+
         self.initUI()
     
 
@@ -188,14 +192,41 @@ class LayerList(QWidget):
     
 
     def layerByName(self, name):
+        return self._layers_by_name.get(name, None)
+
+
+    def _renameLayer(self, layer, name):
+        # Removed layers may still be renamed until they are deleted
+        if layer in self._names_by_layer:
+            self._indexName(layer, name)
+
+    def _indexName(self, layer, name):
+        self._unindexName(layer)
+        self._names_by_layer[layer] = name
+
+        if name in self._layers_by_name:
+            # Another layer has the same name
+            self._resolveName(name)
+        else:
+            self._layers_by_name[name] = layer
+
+    def _unindexName(self, layer):
+        name = self._names_by_layer.pop(layer, None)
+        if name is not None and self._layers_by_name.get(name) is layer:
+            self._resolveName(name)
+
+    def _resolveName(self, name):
+        # The topmost layer of the name, like a scan of the list would find
         for layer in self._layers:
-            if layer.name() == name:
-                return layer
-        return None
+            if self._names_by_layer.get(layer) == name:
+                self._layers_by_name[name] = layer
+                return
+
+        self._layers_by_name.pop(name, None)
     
 
     def index(self, layer):
-        if not isinstance(layer, LayerItem) or layer not in self._layers:
+        if not isinstance(layer, LayerItem) or layer not in self._names_by_layer:
             return -1
 
         return self._layers.index(layer)
@@ -218,6 +249,9 @@ class LayerList(QWidget):
         self._layers.insert(to_index, layer)
         self.layout().insertWidget(to_index, layer)
 
+        # Layers of the same name may have changed order
+        self._resolveName(self._names_by_layer[layer])
+
         lower = min(from_index, to_index)
         upper = max(from_index, to_index)
         for i in range(lower, upper + 1):
@@ -230,12 +264,14 @@ class LayerList(QWidget):
         if layer is None or not isinstance(layer, LayerItem):
             return
 
-        if layer not in self._layers:
+        if layer not in self._names_by_layer:
             layer.clicked.connect(lambda e: self.changeSelection(layer, e))
-
+            layer.nameChanged.connect(lambda name: self._renameLayer(layer, name))
             self._layers.insert(0, layer)
             self.layout().insertWidget(0, layer)
 
+            self._indexName(layer, layer.name())
+
             self.layerAdded.emit()
 
             for i, l in enumerate(self._layers):
@@ -243,11 +279,12 @@ class LayerList(QWidget):
     
 
     def removeLayer(self, layer):
-        if layer in self._layers:
+        if layer in self._names_by_layer:
             name = re.sub(r"^(.*)\s\([0-9]+\)$", r"\1", layer.name())
             self._layer_names[name] = max(0, self._layer_names.get(name, 1) - 1)
      
             self._layers.remove(layer)
+            self._unindexName(layer)
             self.layout().removeWidget(layer)
 
             self.layerRemoved.emit()
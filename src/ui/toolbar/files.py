@@ -5,9 +5,13 @@ from PyQt5.QtWidgets import *
 from src.util.errors import ErrorCode
 import src.util.layers as uLayers
 import src.util.loader as uLoader
+import src.util.threads as threads
+import src.util.dispatch as dispatch
 
 import src.manager.layers as mgLayers
 
+import functools
+
 class ImportFileTool(QAction):
     __instance = None
 
@@ -104,18 +108,37 @@ class ExportFileTool(QAction):
         ends_with_ext = ends_with_png or ends_with_tif
 
 
-        layers = mgLayers.LayerManager.getInstance().allLayers()
+        # The layers are read here, the file is written in the background
+        layers = uLayers.snapshotLayers(
+            mgLayers.LayerManager.getInstance().allLayers())
 
+        save = None
         if ((not ends_with_ext
             and exts == png_ext
             ) or ends_with_png
         ):
-            uLayers.saveAsPng(filename, layers)
+            save = uLayers.saveAsPng
         elif ((not ends_with_ext
             and exts == tif_ext
             ) or ends_with_tif
         ):
-            uLayers.saveAsTif(filename, layers)
+            save = uLayers.saveAsTif
+
+        if save is None:
+            return
+
+        job = threads.TaskScheduler.getInstance().submit(
+            threads.TaskPriority.Export, save, filename, layers)
+        dispatch.MainThreadDispatcher.getInstance().watch(
+            job, functools.partial(self._exportFinished, filename))
+
+
+    def _exportFinished(self, filename, future):
+        # Runs on the main thread, the future is done so this does not block
+        try:
+            future.result()
+        except Exception as e:
+            print("[Error] Export to {} failed: {}".format(filename, e))
 
 
     @staticmethod
@@ -1,6 +1,8 @@
 from PyQt5.QtCore import QPointF
 from PyQt5.QtGui import QColor
 
+import numpy as np
+
 import src.manager.layers as mgLayers
 import src.manager.groups as mgGroups
 import src.backend.groups as beGroups
@@ -11,6 +13,7 @@ import src.ui.canvas.layers as cvLayers
 import src.ui.canvas.matches as cvMatches
 import src.ui.canvas.canvas as canvas
 import src.util.threads as threads
+import src.util.dispatch as dispatch
 from src.util.errors import ErrorCode
 
 Colors = [
@@ -45,26 +48,55 @@ def createSolverFromGroup(be_group):
         return ErrorCode.Align_BusyGroup
 
 
-    def done_with_conover(id):
+    def show_progress(be_layer, stage, iteration, fitness):
+        text = {
+            beSolver.SolverStage.ControlPoints: "Finding control-points... {}",
+            beSolver.SolverStage.Transform: "Estimating transform...",
+            beSolver.SolverStage.Search: "Matching... {}"
+        }[stage].format(iteration)
+
+        if fitness != -1:
+            text += " (best {:.4f})".format(fitness)
+
+        sb_group.setStatus(text)
+
+
+    # Templates that are still being aligned or deformed
+    pending = set(be_group.templateLayers())
+
+    def finish(be_layer):
+        pending.discard(be_layer)
+        if len(pending) > 0:
+            return
+
+        sb_group.cancelRequested.disconnect(solver.cancel)
+        sb_group.setIsProcessing(False)
+
+
+    def done_with_conover(be_layer):
         def done_with_deformation(*args):
+            be_layer.interpolationProgress.disconnect(sb_group.setProgress)
             sb_group.setFitness(result["fitness"])
-            sb_group.setIsProcessing(False)
+            finish(be_layer)
             return
 
-        result = solver.result(id)
+        result = solver.result(be_layer)
 
         if result == None or result["fitness"] == -1:
             sb_group.setFitness(-1)
-            sb_group.setIsProcessing(False)
+            if solver.isCancelled():
+                sb_group.setStatus("Cancelled")
+            finish(be_layer)
             return
 
-        be_layer = result["template"]
         be_layer.setFullResolutionInterpolated(result["aligned_template"])
-        job = threads.ThreadPool.getInstance().submit(
+        be_layer.interpolationProgress.connect(sb_group.setProgress)
+        job = threads.TaskScheduler.getInstance().submit(
+            threads.TaskPriority.Alignment,
             be_layer.setInterpolationCoefficients,
             result["xoptimal"], result["yoptimal"]
         )
-        job.add_done_callback(done_with_deformation)
+        dispatch.MainThreadDispatcher.getInstance().watch(job, done_with_deformation)
 
         index = sbGroups.GroupPane.getInstance().indexOf(sb_group)
 
@@ -83,11 +115,11 @@ def createSolverFromGroup(be_group):
 
             offset = QPointF(result["transform"][0, 2], result["transform"][1, 2])
 
-            for i in range(len(result["keypoints_reference"])):
-                matches.addMatch(
-                    QPointF(*(result["keypoints_reference"][i])) + offset,
-                    QPointF(*(result["keypoints_template"][i]))
-                )
+            matches.addMatches(
+                np.asarray(result["keypoints_reference"]).reshape(-1, 2)
+                    + (offset.x(), offset.y()),
+                result["keypoints_template"]
+            )
             
             cv_layer = mgLayers.LayerManager.getInstance().getLayer(
                 be_layer, cvLayers.PixmapLayer
@@ -100,6 +132,8 @@ def createSolverFromGroup(be_group):
         return
 
     solver.finishedLayer.connect(done_with_conover)
+    solver.progressed.connect(show_progress)
+    sb_group.cancelRequested.connect(solver.cancel)
 
     status = solver.start()
 
@@ -0,0 +1,72 @@
+from PyQt5.QtCore import QObject, pyqtSignal
+
+import queue
+import threading
+
+class MainThreadDispatcher(QObject):
+    """
+    Runs callbacks posted from any thread on the Qt main thread.
+
+    Posted callbacks are queued and the main thread is woken up once, it then
+    runs everything that was posted until then in a single batch. The
+    dispatcher has to be created on the main thread.
+    """
+    __instance = None
+
+    _wake = pyqtSignal()
+
+    def __init__(self):
+        if MainThreadDispatcher.__instance != None:
+            raise Exception("Singleton")
+        else:
+            super().__init__()
+            MainThreadDispatcher.__instance = self
+
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._awake = False
+
+        # Emitted from other threads, so the slot is queued on this thread
+        self._wake.connect(self._drain)
+
+
+    def post(self, callback, *args):
+        self._queue.put((callback, args))
+
+        with self._lock:
+            if self._awake:
+                return
+            self._awake = True
+
+        self._wake.emit()
+
+
+    def watch(self, future, callback):
+        """
+        Calls `callback(future)` on the main thread once the future is done
+        """
+        future.add_done_callback(lambda future: self.post(callback, future))
+
+
+    def _drain(self):
+        # Anything posted after this point wakes the main thread again
+        with self._lock:
+            self._awake = False
+
+        while True:
+            try:
+                callback, args = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                callback(*args)
+            except Exception as e:
+                print("[Error] Dispatched callback failed: {}".format(e))
+
+
+    @staticmethod
+    def getInstance():
+        if MainThreadDispatcher.__instance == None:
+            MainThreadDispatcher()
+        return MainThreadDispatcher.__instance
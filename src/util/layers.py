@@ -49,6 +49,22 @@ def numpyArrayToPixmap(array):
     return QPixmap(qimage)
 
 
+def numpyArrayToPolygon(points):
+    """
+    A QPolygonF of an (N, 2) array of points, written through the memory of
+    the polygon instead of creating a QPointF per point
+    """
+    polygon = QPolygonF(len(points))
+    if len(points) == 0:
+        return polygon
+
+    buffer = polygon.data()
+    buffer.setsize(len(points) * 2 * np.dtype(np.float64).itemsize)
+    np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)[:] = points
+
+    return polygon
+
+
 def createLayerFromFilePath(file_path):
     if not exists(file_path):
         print("[Error] File does not exist: {}".format(file_path))
@@ -126,21 +142,38 @@ def createLayerFromFilePath(file_path):
     return 
 
 
+def snapshotLayers(layers):
+    """
+    Copies what the export needs from the sidebar and canvas layers, so that
+    `saveAsPng` and `saveAsTif` can run outside of the main thread.
+    """
+    return [
+        {
+            "layer": be_layer,
+            "name": sb_layer.name(),
+            "rect": QRectF(cv_layer.sceneBoundingRect()),
+            "resolution": (cv_layer.tifXResolution(), cv_layer.tifYResolution()),
+            "resolution_unit": cv_layer.tifResolutionUnit()
+        }
+        for be_layer, sb_layer, cv_layer in layers
+    ]
+
+
 def _prepareLayersForPng(layers):
     bounds = QRectF()
     result = []
 
     for layer in layers:
-        bounds |= layer[2].sceneBoundingRect() # Union
+        bounds |= layer["rect"] # Union
 
     for layer in layers:
-        rect = layer[2].sceneBoundingRect()
+        rect = layer["rect"]
 
         top = int(rect.top()) - int(bounds.top())
         left = int(rect.left()) - int(bounds.left())
 
         layer_padded = cv2.copyMakeBorder(
-            layer[0].fullResolutionInterpolated(),
+            layer["layer"].fullResolutionInterpolated(),
             top,
             int(bounds.height()) - int(rect.height()) - top,
             left,
@@ -154,6 +187,9 @@ def _prepareLayersForPng(layers):
 
 
 def saveAsPng(file_path, layers):
+    """
+    Composites the layers of a `snapshotLayers` into a single image
+    """
     layers = _prepareLayersForPng(layers)
     
     result = np.zeros(layers[0].shape, dtype=np.float32)
@@ -176,13 +212,16 @@ def saveAsPng(file_path, layers):
 
 
 def saveAsTif(file_path, layers):
-
+    """
+    Saves every layer of a `snapshotLayers` as a page of a tif
+    """
     with TiffImagePlugin.AppendingTiffWriter(file_path, True) as tif_out:
-        for layer_tuple in layers:
-            be_layer, sb_layer, cv_layer = layer_tuple
+        for layer in layers:
+            be_layer = layer["layer"]
+            xresolution, yresolution = layer["resolution"]
 
-            xposition = cv_layer.sceneBoundingRect().left() / float(cv_layer.tifXResolution())
-            yposition = cv_layer.sceneBoundingRect().top() / float(cv_layer.tifYResolution())
+            xposition = layer["rect"].left() / float(xresolution)
+            yposition = layer["rect"].top() / float(yresolution)
 
             pixels = be_layer.fullResolutionInterpolated()
             pixels = np.uint8(np.clip(pixels, 0, 1) * 255)
@@ -201,13 +240,13 @@ def saveAsTif(file_path, layers):
                     # 277: 4, # SamplesPerPixel
                     # 278: 128, # RowsPerStrip
                     # 279: (166400, 166400, 87100), # StripByteCounts
-                    282: cv_layer.tifXResolution(), # XResolution, pixels per ResolutionUnit
-                    283: cv_layer.tifYResolution(), # YResolution, pixels per ResolutionUnit
+                    282: xresolution, # XResolution, pixels per ResolutionUnit
+                    283: yresolution, # YResolution, pixels per ResolutionUnit
                     284: 1, # PlanarConfiguration
-                    285: sb_layer.name(), # PageName
+                    285: layer["name"], # PageName
                     286: xposition, # XPosition
                     287: yposition, # YPosition
-                    296: cv_layer.tifResolutionUnit(), # ResolutionUnit, 2 = inch, 3 = cm
+                    296: layer["resolution_unit"], # ResolutionUnit, 2 = inch, 3 = cm
                     # 297: (1, 2), # PageNumber
                     # 338: (1,), # ExtraSamples
                     # 339: (1, 1, 1, 1), # SampleFormat
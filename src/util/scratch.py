@@ -0,0 +1,47 @@
+import tempfile
+
+import numpy as np
+
+# Directory of the scratch files, the system's temporary directory if None
+ScratchDirectory = None
+
+# Rows are processed in strips of about this many bytes when filling a
+# memory-mapped array, so that no full-size temporary is created
+StripBytes = 16 * 1024 * 1024
+
+
+def allocate(shape, dtype, memory_mapped = False):
+    """
+    Returns a zero-filled array. A memory-mapped array lives in an anonymous
+    scratch file that is removed once the array is released, only the pages
+    that are touched are brought into memory.
+    """
+    if not memory_mapped or np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+
+    # The file is unlinked right away, the mapping keeps it alive
+    with tempfile.TemporaryFile(prefix="irgui-", dir=ScratchDirectory) as file:
+        return np.memmap(file, dtype=dtype, mode="w+", shape=shape)
+
+
+def strips(height, row_bytes):
+    """
+    Yields the row slices to fill an array of the given height in
+    """
+    rows = max(1, StripBytes // max(1, row_bytes))
+    for y in range(0, height, rows):
+        yield slice(y, min(height, y + rows))
+
+
+def fill(out, compute, *sources):
+    """
+    Fills `out` with `compute(*source_strips)` strip by strip, where the
+    sources have the same height as `out`. Returns `out`.
+    """
+    row_bytes = max(
+        [out[:1].nbytes] + [np.asarray(source[:1]).nbytes for source in sources])
+
+    for rows in strips(out.shape[0], row_bytes):
+        out[rows] = compute(*(source[rows] for source in sources))
+
+    return out
@@ -0,0 +1,123 @@
+from multiprocessing import shared_memory
+
+import contextlib
+import threading
+
+import numpy as np
+
+class SharedArray:
+    """
+    A numpy array backed by shared memory, so that worker processes can read
+    it without it being pickled. Workers receive the small `handle()` and use
+    `attachSharedArray` to access the data.
+
+    An owner that replaces the array calls `retire` instead of `close`, the
+    memory is then released once the last user that called `acquire` calls
+    `release`, so work that is still queued on the old handle can attach.
+    """
+
+    def __init__(self, array, dtype = None):
+        # Set first, so that close and __del__ work if the rest fails
+        self._shm = None
+        self._array = None
+        self._lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+
+        array = np.asarray(array)
+        dtype = np.dtype(dtype or array.dtype)
+        nbytes = int(np.prod(array.shape)) * dtype.itemsize
+
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=max(1, nbytes))
+
+        try:
+            self._array = np.ndarray(
+                array.shape, dtype=dtype, buffer=self._shm.buf)
+            # Converts to the dtype without an intermediate copy
+            self._array[...] = array
+        except Exception:
+            self.close()
+            raise
+
+        self._handle = (self._shm.name, array.shape, dtype.str)
+
+
+    def handle(self):
+        return self._handle
+
+    def array(self):
+        return self._array
+
+
+    def acquire(self):
+        """
+        Keeps the memory alive until `release`, returns the array itself
+        """
+        with self._lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users = max(0, self._users - 1)
+            unused = self._retired and self._users == 0
+        if unused:
+            self.close()
+
+
+    def retire(self):
+        """
+        Closes the memory as soon as it has no users left
+        """
+        with self._lock:
+            self._retired = True
+            unused = self._users == 0
+        if unused:
+            self.close()
+
+
+    def close(self):
+        shm = getattr(self, "_shm", None)
+        if shm is None:
+            return
+
+        self._array = None
+        self._shm = None
+        shm.close()
+        shm.unlink()
+
+
+    def __del__(self):
+        self.close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def releaseWhenDone(future, *shared_arrays):
+    """
+    Releases acquired shared arrays once the future is done, also when its
+    result is never waited for
+    """
+    def release(future):
+        for shared in shared_arrays:
+            shared.release()
+
+    future.add_done_callback(release)
+
+
+@contextlib.contextmanager
+def attachSharedArray(handle):
+    name, shape, dtype = handle
+
+    shm = shared_memory.SharedMemory(name=name)
+
+    try:
+        yield np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    finally:
+        shm.close()
@@ -1,18 +1,192 @@
 import concurrent.futures as futures
+import multiprocessing
+import threading
+import time
+import os
 
-class ThreadPool(futures.ThreadPoolExecutor):
+import cv2
+
+class TaskPriority:
+    # Short work the user is waiting on, such as pixmaps and thumbnails
+    Interactive = 0
+    # Solver jobs and deformations
+    Alignment = 1
+    Export = 2
+
+
+class TaskScheduler:
+    """
+    Runs background work on a separate pool of threads per TaskPriority, so
+    that interactive work never queues behind a long alignment.
+
+    OpenCV parallelizes most of its functions over its own threads as well,
+    those are limited such that the alignment workers together roughly use
+    every core once.
+    """
     __instance = None
+    __lock = threading.Lock()
+
+    CpuCount = os.cpu_count() or 1
+
+    DefaultWorkers = {
+        TaskPriority.Interactive: 2,
+        TaskPriority.Alignment: max(1, CpuCount // 2),
+        TaskPriority.Export: 1
+    }
 
     def __init__(self):
-        if ThreadPool.__instance != None:
+        if TaskScheduler.__instance != None:
             raise Exception("Singleton")
         else:
-            super().__init__(None)
-            ThreadPool.__instance = self
-        
+            TaskScheduler.__instance = self
+
+        self._workers = TaskScheduler.DefaultWorkers.copy()
+        self._executors = {
+            priority: futures.ThreadPoolExecutor(count)
+            for priority, count in self._workers.items()
+        }
+
+        self._updateOpenCVThreads()
+
+
+    def workerCount(self, priority):
+        return self._workers[priority]
+
+    def setWorkerCount(self, priority, count):
+        """
+        Tasks that were already submitted finish on the previous threads
+        """
+        count = max(1, count)
+        if count == self._workers[priority]:
+            return
+
+        with TaskScheduler.__lock:
+            self._executors[priority].shutdown(wait=False)
+            self._executors[priority] = futures.ThreadPoolExecutor(count)
+            self._workers[priority] = count
+
+        self._updateOpenCVThreads()
+
+
+    def coresPerTask(self, priority):
+        """
+        The share of the cores of a single task of the priority, when all of
+        its workers are busy
+        """
+        return max(1, TaskScheduler.CpuCount // self._workers[priority])
+
+
+    def submit(self, priority, fn, /, *args, **kwargs):
+        with TaskScheduler.__lock:
+            executor = self._executors[priority]
+        return executor.submit(fn, *args, **kwargs)
+
+
+    def shutdown(self, wait = True):
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
+
+
+    def _updateOpenCVThreads(self):
+        cv2.setNumThreads(self.coresPerTask(TaskPriority.Alignment))
+
 
     @staticmethod
     def getInstance():
-        if ThreadPool.__instance == None:
-            ThreadPool()
-        return ThreadPool.__instance
+        with TaskScheduler.__lock:
+            if TaskScheduler.__instance == None:
+                TaskScheduler()
+        return TaskScheduler.__instance
+
+
+def _initializeProcess():
+    # Every worker process gets a core of its own
+    cv2.setNumThreads(1)
+
+
+class ProcessPool(futures.ProcessPoolExecutor):
+    __instance = None
+    # The pool is first used from worker threads
+    __lock = threading.Lock()
+
+    def __init__(self):
+        if ProcessPool.__instance != None:
+            raise Exception("Singleton")
+        else:
+            # Forking a process that runs Qt and worker threads is unsafe
+            super().__init__(
+                None,
+                multiprocessing.get_context("spawn"),
+                _initializeProcess
+            )
+            ProcessPool.__instance = self
+
+
+    @staticmethod
+    def getInstance():
+        with ProcessPool.__lock:
+            if ProcessPool.__instance == None:
+                ProcessPool()
+        return ProcessPool.__instance
+
+
+class Cancelled(Exception):
+    """
+    Raised by `CancellationToken.check` in a job that should stop
+    """
+
+
+def waitForResult(future, cancel_token = None, interval = 0.1):
+    """
+    Waits for the result of a future while checking the cancellation token,
+    a cancelled wait cancels the future if it has not started yet.
+    """
+    while True:
+        try:
+            return future.result(interval)
+        except futures.TimeoutError:
+            pass
+
+        if cancel_token is not None:
+            try:
+                cancel_token.check()
+            except Cancelled:
+                future.cancel()
+                raise
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation of a job, the job itself calls `check` between
+    its steps.
+
+    A token is cancelled by `cancel` and expires once its timeout in seconds
+    has passed, a token with a parent is also cancelled or expired when its
+    parent is.
+    """
+
+    def __init__(self, parent = None, timeout = None):
+        self._event = threading.Event()
+        self._parent = parent
+        self._deadline = None if timeout is None else time.monotonic() + timeout
+
+
+    def cancel(self):
+        self._event.set()
+
+    def isCancelled(self):
+        return (self._event.is_set()
+            or (self._parent is not None and self._parent.isCancelled()))
+
+
+    def isExpired(self):
+        return ((self._deadline is not None and time.monotonic() >= self._deadline)
+            or (self._parent is not None and self._parent.isExpired()))
+
+
+    def check(self):
+        """
+        Raises `Cancelled` if the token is cancelled or expired
+        """
+        if self.isCancelled() or self.isExpired():
+            raise Cancelled()